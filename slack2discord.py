@@ -7,28 +7,1701 @@
 # or referencing channels not created yet.
 # Also note that mentions will only be properly migrated for users already on the discord server.
 # To fascilitate the fact that people use different nicks, there is a slack2discord.json file where you can map those (if no mapping exists, it just attempts to match name).
-# TODO Properly migrate the assets to discord, rather than embedded url's
-# TODO Post messages looking like the mapped user (webhooks? send() can specify username there)
+# Files can be re-uploaded to discord as real attachments, rather than embedded url's (see DOWNLOAD_FILES)
+# Messages can be posted looking like the slack user through webhooks (see USE_WEBHOOKS)
+import argparse
+import asyncio
+import bisect
+import calendar
+import contextvars
+import functools
+import hashlib
+import io
 import json
+import logging
+import logging.handlers
+import marshal
+import multiprocessing
+import re
+import shutil
+import sqlite3
 import sys
 import os
+import random
+import threading
 import time
-from datetime import datetime
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import aiohttp
 import discord
 from discord.ext import commands
+try:
+    import ijson # Optional: faster incremental parsing of large .json logs
+except ImportError:
+    ijson = None
 
 MAX_EMBEDS = 1
 if discord.__version__[0] >= "2":
     MAX_EMBEDS = 10
 
 MAX_CHARACTERS = 2000
+MAX_FILES = 10
+# Prefix of the messages a message exceeding MAX_CHARACTERS is split into, after the first
+CONTINUATION_PREFIX = "*continuation:*\n"
+CODE_FENCE = "```"
+# Longest language of a code block that is carried over when re-opening it in a continuation
+MAX_FENCE_LANGUAGE = 16
 
+# Characters read from a .json file at a time when streaming its contents
+JSON_READ_SIZE = 1 << 16
+
+# Route all requests through the rate-limit scheduler, pre-emptively waiting on exhausted buckets
 THROTTLE = True
-THROTTLE_TIME_SECONDS = 0.1
+# Discord's global limit of requests per second for a bot, shared across all routes
+GLOBAL_RATE_LIMIT = 50
+# Attempts of a request failing with a server (5xx) or connection error, before giving up on it.
+#  Attempts are spaced by a random delay of up to RETRY_BACKOFF_SECONDS, doubling every attempt up to RETRY_MAX_BACKOFF_SECONDS
+RETRY_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 1.0
+RETRY_MAX_BACKOFF_SECONDS = 60.0
+# Number of channels imported concurrently by import_all/import_path.
+#  Each channel has its own rate-limit bucket, while all of them share the global one.
+IMPORT_WORKERS = 4
+# Tokens of additional bots in the same server (see --sender-token), importing part of the channels alongside the bot.
+#  Each channel is assigned to one of the bots by its name, and every bot sends through its own rate limits,
+#  with IMPORT_WORKERS channels at a time.
+SENDER_TOKENS = []
+# Seconds between logging the combined progress of the bots while importing
+PROGRESS_INTERVAL_SECONDS = 60
+# Processes parsing .json logs into send-ready messages ahead of the sender (0 to parse in a background thread instead)
+PARSE_PROCESSES = min(4, os.cpu_count() or 1)
+# Messages selected from the index (see MessageStore) handed to a parse process at a time
+PARSE_BATCH = 500
+# Parsed messages queued ahead of the sender of each channel, capping the memory used by parsing ahead.
+#  The files of queued messages are downloaded in the background meanwhile.
+PIPELINE_DEPTH = 100
+
+# Post messages through webhooks, under the name and avatar of their slack author,
+#  instead of as the bot with a "**{username}** *(timestamp)*" header.
+#  Requires the bot to have the "Manage Webhooks" permission.
+USE_WEBHOOKS = False
+WEBHOOK_NAME = "slack2discord"
+# Discord's limit on the length of a webhook's username
+MAX_USERNAME_CHARACTERS = 80
+# Words discord rejects webhook usernames containing, and the look-alike letters they are spelled with instead
+FORBIDDEN_USERNAME_WORDS = re.compile(r"discord|clyde", re.IGNORECASE)
+FORBIDDEN_USERNAME_LETTERS = str.maketrans("oOyY", "00iI")
+
+# Threads kept open (unarchived) at once while importing, well below discord's cap on active threads per guild.
+#  Once exceeded, the least recently used thread is archived.
+MAX_OPEN_THREADS = 50
+# Discord's limit on the length of a thread's name
+MAX_THREAD_NAME_CHARACTERS = 100
+
+# Merge consecutive messages by the same user sent within this many seconds into one message (None to disable).
+#  Can be overridden per import with the --coalesce option.
+COALESCE_WINDOW_SECONDS = None
+
+# Only import what is newer than the last import into the same server, by the high-water marks in the journal.
+#  Can be enabled per import with the --incremental option.
+INCREMENTAL = False
+
+# Download slack files and upload them to discord as attachments, rather than embedding links to slack.
+#  Can be enabled per import with the --download-files option.
+DOWNLOAD_FILES = False
+# Cache of downloaded files, stored in the slack-root
+FILE_CACHE_NAME = "slack2discord_files"
+MAX_CONCURRENT_DOWNLOADS = 8
+# Token sent to slack when downloading files, if the export's file urls require one
+SLACK_TOKEN = os.environ.get("SLACK_TOKEN")
+
+# Journal of imported messages and threads, stored in the slack-root, used to resume interrupted imports
+JOURNAL_NAME = "slack2discord_journal.sqlite"
+# Index of the messages in the .json logs, stored in the slack-root, which imports select messages from
+INDEX_NAME = "slack2discord_index.sqlite"
+# Version of the import plan format (see compile_plan()), and lines of a plan read at a time when replaying it
+PLAN_VERSION = 1
+PLAN_BATCH = 500
+
+# Messages that failed to send, stored in the slack-root as JSON-lines, to be imported again with --dead-letters
+DEAD_LETTERS_NAME = "slack2discord_dead_letters.jsonl"
+# Files and directories slack2discord keeps in the slack-root are named with this prefix,
+#  so they are never taken for .json logs or channels
+STATE_PREFIX = "slack2discord_"
+# Listing of the export's directories and .json logs, stored in the slack-root, reused while the directories are unchanged
+MANIFEST_NAME = "slack2discord_manifest.json"
+# Users @mentioned by each .json log, stored in the slack-root, so only those members are looked up on discord
+MENTIONS_NAME = "slack2discord_mentions.json"
+# Lookup tables compiled from users.json, channels.json and slack2discord_users.json, stored in the slack-root,
+#  reused while the files are unchanged
+LOOKUP_TABLES_NAME = "slack2discord_tables.bin"
+
+# Metrics of the running import (see ImportMetrics), written every PROGRESS_INTERVAL_SECONDS into the slack-root,
+#  or to METRICS_FILE if set. Written in the Prometheus textfile format instead of JSON if the path ends with .prom
+METRICS_NAME = "slack2discord_metrics.json"
+METRICS_FILE = None
+# Latencies of the most recent sends kept per channel, to report percentiles of
+METRICS_LATENCY_SAMPLES = 1000
+
+# Simulated discord behaviour when doing a dry-run (see DryRunTransport)
+DRY_RUN_LATENCY_SECONDS = 0.15
+# Requests per route within each window of seconds, as (requests, seconds)
+DRY_RUN_RATE_LIMIT = (5, 5.0)
+
+# Answer to the confirmations of parse_slack_directory, such as continuing without a root file.
+#  None asks on the terminal (if any), otherwise set with --yes / --no.
+ASSUME_YES = None
+
+# Console output level; per-message progress is only logged at DEBUG (see --verbose and --quiet)
+LOG_LEVEL = logging.INFO
+# Occurrences of each kind of repeated warning shown before the rest are only counted, in the end-of-import summary
+LOG_SUMMARY_SHOWN = 3
+# Records buffered in memory before being written to the --log-file (errors are written immediately)
+LOG_BUFFER_RECORDS = 1000
+
+log = logging.getLogger("slack2discord")
+
+
+class SummaryFilter(logging.Filter):
+    """
+    Aggregates repeated warnings, such as an unmapped user, on the console.
+    Records logged with `extra={"summary": kind}` are shown the first LOG_SUMMARY_SHOWN
+    times for each kind; any further ones are only counted, and reported by summarize().
+    """
+    def __init__(self, shown=LOG_SUMMARY_SHOWN):
+        super().__init__()
+        self.shown = shown
+        self.counts = {} # kind -> occurrences
+
+    def filter(self, record):
+        kind = getattr(record, "summary", None)
+        if kind is None:
+            return True
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        return self.counts[kind] <= self.shown
+
+    def summarize(self):
+        """
+        Logs the occurrences of each kind of repeated warning since the last summary
+        """
+        if self.counts:
+            log.info("Summary of repeated warnings:\n" + "\n".join(
+                f"       {kind}: {count} times" + (f" ({count - self.shown} not shown)" if count > self.shown else "")
+                for kind, count in sorted(self.counts.items())))
+        self.counts = {}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats every record as a single line of JSON, for post-processing of --log-file
+    """
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if hasattr(record, "summary"):
+            entry["summary"] = record.summary
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+summary_filter = SummaryFilter()
+
+
+def setup_logging(level=LOG_LEVEL, log_file=None):
+    """
+    Configures console output, and optionally a JSON-lines log file.
+    The log file receives every record, including the repeated warnings left out of the console.
+    :param level: Minimum level of logged records
+    :param log_file: Path of the JSON-lines log file, or None
+    """
+    log.setLevel(level)
+    log.propagate = False
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    console.addFilter(summary_filter)
+    log.addHandler(console)
+    if log_file:
+        target = logging.FileHandler(log_file, encoding="utf-8")
+        target.setFormatter(JsonLinesFormatter())
+        log.addHandler(logging.handlers.MemoryHandler(LOG_BUFFER_RECORDS, logging.ERROR, target))
+
+
+def summary(kind):
+    """
+    :param kind: Kind of a repeated warning, which the summary_filter aggregates
+    :return: `extra` argument of a log call
+    """
+    return {"summary": kind}
+
+
+# Errors of a request that may succeed when sent again
+TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
+# Errors of a request that failed to connect, so it certainly did not reach discord
+UNSENT_ERRORS = (aiohttp.ClientConnectorError,)
+# Server errors discord.py already retries a request on by itself, before raising them
+RETRIED_SERVER_ERRORS = {500, 502, 504, 524}
+# Errors of sending a message, after its retries, which leave the message to the dead letters rather than failing its channel
+SEND_ERRORS = (discord.HTTPException,) + TRANSIENT_ERRORS
+
+
+def is_transient(error, idempotent=True):
+    """
+    :param error: Exception raised by a request
+    :param idempotent: Whether the request can safely be repeated even if an earlier attempt reached discord
+    :return: Whether the request may succeed if retried, i.e. it failed on discord's side (5xx, unless discord.py
+             retried it already) or the connection. A request that is not idempotent is only retried if it failed
+             to connect, as it may otherwise have been carried out.
+    """
+    if not idempotent:
+        return isinstance(error, UNSENT_ERRORS)
+    if isinstance(error, discord.HTTPException):
+        return error.status >= 500 and error.status not in RETRIED_SERVER_ERRORS
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class RateLimitScheduler:
+    """
+    Schedules discord API requests against the rate-limit buckets discord reports,
+    rather than sleeping a fixed amount after every request.
+    Buckets are tracked per route (method + major parameter) and updated from the
+    X-RateLimit-* response headers, captured through an aiohttp trace hook.
+    A global bucket caps the combined request rate across all routes.
+    Requests failing with a transient error are retried with a jittered, exponential backoff (see RETRY_ATTEMPTS).
+    """
+    # Snowflakes that are not major parameters share the bucket of their route
+    _MINOR_ID = re.compile(r"(?<!channels)(?<!guilds)(?<!webhooks)/\d{15,21}")
+    _WEBHOOK_TOKEN = re.compile(r"(/webhooks/\d+)/[^/?]+")
+    _API_PREFIX = re.compile(r"^/api(/v\d+)?")
+
+    def __init__(self, global_limit=GLOBAL_RATE_LIMIT):
+        self.global_limit = global_limit
+        self.buckets = {} # route -> {"limit", "remaining", "reset"}
+        self.locks = {} # route -> asyncio.Lock, keeping requests on a route in order
+        self.global_window = deque() # start times of requests within the last second
+        self.global_reset = 0.0
+        self.waited = 0.0 # total seconds spent waiting on buckets
+        self.requests = 0 # total requests made
+        self.retries = 0 # total requests retried after a transient error
+
+    @classmethod
+    def route_key(cls, method, path):
+        """
+        Normalizes a request path into the key of its rate-limit bucket
+        :param method: HTTP method of the request
+        :param path: URL path of the request, with or without the /api/vX prefix
+        :return: String key, such as "POST /channels/123/messages/:id/threads"
+        """
+        path = cls._API_PREFIX.sub("", path)
+        path = cls._WEBHOOK_TOKEN.sub(r"\1", path)
+        path = cls._MINOR_ID.sub("/:id", path)
+        return f"{method.upper()} {path}"
+
+    def trace_config(self):
+        """
+        Creates an aiohttp trace config feeding response headers back into the buckets.
+        Passed to the bot as `http_trace` (discord.py >= 2.0).
+        """
+        async def on_request_end(session, trace_ctx, params):
+            self.update(self.route_key(params.method, params.url.path), params.response.headers)
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(on_request_end)
+        return trace
+
+    def update(self, route, headers):
+        """
+        Updates the bucket of a route from the rate-limit headers of its response
+        :param route: Route key as given by route_key()
+        :param headers: Response headers
+        """
+        now = time.monotonic()
+        if "Retry-After" in headers and headers.get("X-RateLimit-Global", "").lower() == "true":
+            self.global_reset = now + float(headers["Retry-After"])
+            return
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        bucket = self.buckets.setdefault(route, {})
+        bucket["limit"] = int(headers.get("X-RateLimit-Limit", 1))
+        bucket["remaining"] = int(headers["X-RateLimit-Remaining"])
+        reset_after = headers.get("X-RateLimit-Reset-After", headers.get("Retry-After"))
+        bucket["reset"] = now + float(reset_after) if reset_after else now
+        if "Retry-After" in headers:
+            bucket["remaining"] = 0
+
+    async def _wait_for_bucket(self, route):
+        bucket = self.buckets.get(route)
+        if not bucket:
+            return
+        now = time.monotonic()
+        if bucket["reset"] <= now:
+            bucket["remaining"] = bucket["limit"]
+        elif bucket["remaining"] <= 0:
+            delay = bucket["reset"] - now
+            self.waited += delay
+            await asyncio.sleep(delay)
+            bucket["remaining"] = bucket["limit"]
+        bucket["remaining"] -= 1
+
+    async def _wait_for_global(self):
+        while True:
+            now = time.monotonic()
+            if self.global_reset > now:
+                delay = self.global_reset - now
+            else:
+                while self.global_window and self.global_window[0] <= now - 1:
+                    self.global_window.popleft()
+                if len(self.global_window) < self.global_limit:
+                    self.global_window.append(now)
+                    return
+                delay = self.global_window[0] + 1 - now
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+    async def request(self, route, func, *args, idempotent=True, **kwargs):
+        """
+        Awaits func(*args, **kwargs) once both the route's bucket and the global bucket allow it,
+        retrying it if it fails with a transient error
+        :param route: Route key as given by route_key()
+        :param func: Coroutine function performing the request, safe to call again after a transient error
+        :param idempotent: Whether the request can safely be repeated even if an earlier attempt reached discord,
+                           see is_transient()
+        :return: Result of the request
+        :raises Exception: The error of the last attempt, if not transient or out of attempts
+        """
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                return await self._request(route, func, *args, **kwargs)
+            except Exception as e:
+                if attempt >= RETRY_ATTEMPTS or not is_transient(e, idempotent):
+                    raise
+                delay = random.uniform(0, min(RETRY_MAX_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)))
+                log.warning(f"Request failed, retrying in {delay:.1f}s ({attempt}/{RETRY_ATTEMPTS}): {route}\n"
+                            f"        {type(e).__name__}: {e}", extra=summary("Request failed, retrying"))
+                self.retries += 1
+                metrics.count("retries")
+                await asyncio.sleep(delay)
+
+    async def _request(self, route, func, *args, **kwargs):
+        self.requests += 1
+        queued = time.monotonic()
+        if not THROTTLE:
+            result = await func(*args, **kwargs)
+            metrics.request(route, 0.0, time.monotonic() - queued)
+            return result
+        lock = self.locks.setdefault(route, asyncio.Lock())
+        async with lock:
+            await self._wait_for_bucket(route)
+            await self._wait_for_global()
+            started = time.monotonic()
+            result = await func(*args, **kwargs)
+        metrics.request(route, started - queued, time.monotonic() - started)
+        return result
+
+
+scheduler = RateLimitScheduler()
+# Scheduler of the bot sending on behalf of the running task, set by the import workers of other bots (see Sender)
+current_scheduler = contextvars.ContextVar("current_scheduler", default=scheduler)
+
+
+class Sender:
+    """
+    A bot importing the channels assigned to it, through its own rate-limit scheduler.
+    The main bot, which the import commands are run through, is a sender without a client of its own.
+    Additional senders are bots in the same server, connected with the tokens of SENDER_TOKENS.
+    """
+    def __init__(self, name, client=None, rate_limits=None):
+        self.name = name
+        self.client = client
+        self.scheduler = rate_limits or scheduler
+        self.task = None # task running the client's connection
+
+    @classmethod
+    async def connect(cls, token, name):
+        """
+        Logs a bot in and waits for it to be ready
+        :param token: Token of the bot
+        :param name: Name of the sender, used in the log
+        :return: Sender
+        :raises discord.DiscordException: If the bot fails to log in or connect
+        """
+        rate_limits = RateLimitScheduler()
+        options = {}
+        if discord.__version__[0] >= "2":
+            options["http_trace"] = rate_limits.trace_config()
+        client = discord.Client(intents=discord.Intents.default(), **options)
+        await client.login(token)
+        sender = cls(name, client, rate_limits)
+        sender.task = asyncio.ensure_future(client.connect())
+        ready = asyncio.ensure_future(client.wait_until_ready())
+        await asyncio.wait([ready, sender.task], return_when=asyncio.FIRST_COMPLETED)
+        if not ready.done():
+            ready.cancel()
+            await client.close()
+            sender.task.result() # raises why the connection ended
+            raise discord.ClientException("Connection closed before the bot was ready")
+        return sender
+
+    async def resolve(self, channel):
+        """
+        :param channel: Channel as seen by the main bot
+        :return: The channel as seen by this sender's bot, so requests on it are made with its token
+        """
+        if self.client is None:
+            return channel
+        return self.client.get_channel(channel.id) or await self.scheduler.request(
+            channel_route("GET", channel), self.client.fetch_channel, channel.id)
+
+    async def close(self):
+        if self.client:
+            await self.client.close()
+
+
+# Connected additional senders, by token
+senders = {}
+
+
+async def connect_senders():
+    """
+    Connects the bots of SENDER_TOKENS that are not connected yet.
+    A bot that fails to connect is left out, and retried by the next import.
+    :return: List of the connected additional senders, in the order of SENDER_TOKENS
+    """
+    for i, token in enumerate(SENDER_TOKENS, 1):
+        if token not in senders:
+            log.info(f"Connecting sender bot #{i}")
+            try:
+                senders[token] = await Sender.connect(token, f"bot #{i}")
+            except discord.DiscordException as e:
+                log.error(f"Unable to connect sender bot #{i} - its channels are imported by the other bots\n"
+                          f"        {type(e).__name__}: {e}")
+    return [senders[token] for token in SENDER_TOKENS if token in senders]
+
+
+async def close_senders():
+    while senders:
+        _, sender = senders.popitem()
+        await sender.close()
+
+
+def percentiles(samples, quantiles=(0.5, 0.95, 0.99)):
+    """
+    :param samples: Iterable of numbers
+    :param quantiles: Quantiles to compute, between 0 and 1
+    :return: Dict of quantile => value (nearest rank), or an empty dict if there are no samples
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles}
+
+
+# Name of the channel being imported by the running task, which its requests are counted towards (see ImportMetrics)
+current_channel = contextvars.ContextVar("current_channel", default=None)
+
+
+class ImportMetrics:
+    """
+    Progress of the running import, per channel and overall: the .json logs (or batches) and messages processed,
+    the messages sent and split, the threads created, the waits on rate limits and the latency of sends.
+    Requests are counted towards the channel imported by the task making them (see current_channel).
+    The ETA extrapolates the rate messages were processed at over the messages left, which are counted
+    when messages are selected from the index, and otherwise estimated from the size of the .json logs left.
+    Only the most recently started import is tracked.
+    """
+    # Counters of each channel, in the order they are reported
+    COUNTERS = ("files", "bytes", "messages", "skipped", "failed", "sends", "splits", "threads", "requests", "retries",
+                "rate_limit_waits", "rate_limit_seconds")
+
+    def __init__(self):
+        self.started = None
+        self.finished = None
+        self.channels = {} # name -> {"state", counters, "bytes_total", "messages_total", "latencies"}
+
+    def start(self, order, sizes):
+        """
+        :param order: Names of the channels to import, in order
+        :param sizes: Dict of channel => bytes of its .json logs
+        """
+        self.started, self.finished = time.time(), None
+        self.channels = {ch: dict({k: 0 for k in self.COUNTERS}, state="pending", bytes_total=sizes.get(ch, 0),
+                                  messages_total=None, latencies=deque(maxlen=METRICS_LATENCY_SAMPLES))
+                         for ch in order}
+
+    def finish(self):
+        self.finished = time.time()
+
+    def channel(self, name=None):
+        """
+        :param name: Name of the channel, defaulting to the one imported by the running task
+        :return: Dict of the channel's metrics, or None if it is not being imported
+        """
+        return self.channels.get(name or current_channel.get())
+
+    def count(self, counter, n=1, name=None):
+        channel = self.channel(name)
+        if channel is not None:
+            channel[counter] += n
+
+    def source(self, source, name=None):
+        """
+        Counts a .json log, or batch of messages, handed to the parse pool
+        :param source: Path to a .json log, or a list of messages as json strings
+        :param name: Name of the channel, defaulting to the one imported by the running task
+        """
+        channel = self.channel(name)
+        if channel is None:
+            return
+        channel["files"] += 1
+        if isinstance(source, str):
+            try:
+                channel["bytes"] += export_stat(source)[0]
+            except OSError:
+                pass
+
+    def request(self, route, waited, latency):
+        """
+        Counts a request made by the running task
+        :param route: Route key of the request, as given by RateLimitScheduler.route_key()
+        :param waited: Seconds the request was held back by the rate limits (including requests queued ahead of it)
+        :param latency: Seconds the request took, once sent
+        """
+        channel = self.channel()
+        if channel is None:
+            return
+        channel["requests"] += 1
+        if waited > 0.001:
+            channel["rate_limit_waits"] += 1
+            channel["rate_limit_seconds"] += waited
+        if route.startswith("POST") and (route.endswith("/messages") or route.startswith("POST /webhooks/")):
+            channel["sends"] += 1
+            channel["latencies"].append(latency)
+
+    def left(self):
+        """
+        :return: Number of messages left to process, counted or estimated
+        """
+        # Messages per byte of .json log, preferably of the channels completed, as the others are parsed ahead
+        done = [c for c in self.channels.values() if c["state"] in ("done", "failed") and c["bytes"]] \
+            or [c for c in self.channels.values() if c["bytes"]]
+        per_byte = sum(c["messages"] + c["skipped"] + c["failed"] for c in done) / max(1, sum(c["bytes"] for c in done))
+        left = 0
+        for c in self.channels.values():
+            if c["state"] in ("done", "failed"):
+                continue
+            total = c["messages_total"] if c["messages_total"] is not None else c["bytes_total"] * per_byte
+            left += max(0, total - c["messages"] - c["skipped"] - c["failed"])
+        return round(left)
+
+    def status(self):
+        """
+        :return: Dict of the overall metrics (including "elapsed", "rate" in messages per second and "eta" in seconds),
+                 and the metrics of each channel under "channels"
+        """
+        now = self.finished or time.time()
+        elapsed = now - self.started if self.started else 0.0
+        channels = {}
+        for name, c in self.channels.items():
+            channels[name] = {k: v for k, v in c.items() if k != "latencies"}
+            channels[name]["send_latency"] = percentiles(c["latencies"])
+        totals = {k: sum(c[k] for c in self.channels.values()) for k in self.COUNTERS}
+        processed = totals["messages"] + totals["skipped"] + totals["failed"]
+        rate = processed / elapsed if elapsed else 0.0
+        left = self.left() if self.started and not self.finished else 0
+        states = [c["state"] for c in self.channels.values()]
+        return dict(totals, started=self.started, finished=self.finished, elapsed=elapsed, rate=rate, left=left,
+                    eta=left / rate if rate else None,
+                    channels_total=len(states), channels_done=states.count("done"), channels_failed=states.count("failed"),
+                    send_latency=percentiles(l for c in self.channels.values() for l in c["latencies"]),
+                    channels=channels)
+
+    def format(self):
+        """
+        :return: Human readable summary of the status, for !import_status
+        """
+        if not self.started:
+            return "No import has been started"
+        status = self.status()
+        eta = "unknown" if status["eta"] is None else timedelta(seconds=round(status["eta"]))
+        latency = ", ".join(f"p{round(q * 100)} {v * 1000:.0f} ms" for q, v in status["send_latency"].items()) or "-"
+        lines = [f"**Import {'complete' if status['finished'] else 'in progress'}** - "
+                 f"{timedelta(seconds=round(status['elapsed']))} elapsed, ETA {eta if not status['finished'] else '-'}",
+                 f"Channels: {status['channels_done']}/{status['channels_total']} done, {status['channels_failed']} failed",
+                 f"Messages: {status['messages']} imported, {status['skipped']} skipped, {status['failed']} failed, ~{status['left']} left "
+                 f"({status['rate']:.1f}/s), from {status['files']} .json logs or batches",
+                 f"Sends: {status['sends']} ({status['splits']} split off), {status['threads']} threads created, "
+                 f"latency {latency}",
+                 f"Rate limits: {status['rate_limit_waits']} waits, {timedelta(seconds=round(status['rate_limit_seconds']))} in total, "
+                 f"{status['retries']} requests retried"]
+        for name, c in status["channels"].items():
+            if c["state"] in ("importing", "failed"):
+                total = c["messages_total"] if c["messages_total"] is not None else "?"
+                lines.append(f"- #{name}: {c['state']}, {c['messages'] + c['skipped'] + c['failed']}/{total} messages, {c['sends']} sends")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """
+        Writes the status to a file, as JSON or, if the path ends with .prom, in the Prometheus textfile format
+        :param path: Path to the file, which is replaced atomically
+        """
+        status = self.status()
+        if path.endswith(".prom"):
+            lines = []
+            for key in ("elapsed", "rate", "left", "eta", "channels_total", "channels_done", "channels_failed"):
+                lines += [f"# TYPE slack2discord_{key} gauge", f"slack2discord_{key} {status[key] or 0}"]
+            for key in self.COUNTERS:
+                lines.append(f"# TYPE slack2discord_{key} gauge")
+                lines += [f'slack2discord_{key}{{channel="{name}"}} {c[key]}' for name, c in status["channels"].items()]
+            lines.append(f"# TYPE slack2discord_send_latency_seconds summary")
+            for name, c in status["channels"].items():
+                lines += [f'slack2discord_send_latency_seconds{{channel="{name}",quantile="{q}"}} {v}'
+                          for q, v in c["send_latency"].items()]
+            content = "\n".join(lines) + "\n"
+        else:
+            content = json.dumps(dict(status, send_latency={str(q): v for q, v in status["send_latency"].items()},
+                                      channels={name: dict(c, send_latency={str(q): v for q, v in c["send_latency"].items()})
+                                                for name, c in status["channels"].items()}), indent=1)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            log.warning(f"Unable to write metrics: {e}", extra=summary("Unable to write metrics"))
+
+
+metrics = ImportMetrics()
+
+
+class WebhookPool:
+    """
+    Creates and reuses one webhook per target channel, used to post messages under the identity of their author.
+    Threads are posted to through the webhook of their parent channel.
+    Webhook executions have their own rate-limit buckets, separate from the bot's channel sends.
+    """
+    def __init__(self):
+        self.webhooks = {} # channel id -> webhook, or None if webhooks are unavailable in the channel
+        self.locks = {} # channel id -> asyncio.Lock, so concurrent senders don't create duplicate webhooks
+
+    async def get(self, channel):
+        """
+        Gets the webhook of a channel, reusing an existing slack2discord webhook or creating one
+        :param channel: TextChannel to post in
+        :return: Webhook, or None if the bot is not allowed to manage the channel's webhooks
+        """
+        lock = self.locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            if channel.id not in self.webhooks:
+                webhook = None
+                try:
+                    existing = await current_scheduler.get().request(channel_route("GET", channel, "/webhooks"), channel.webhooks)
+                    # Only webhooks created by a bot come with a token to post through
+                    webhook = next((w for w in existing if w.name == webhook_username(WEBHOOK_NAME) and w.token), None)
+                    if not webhook:
+                        log.info(f"Creating webhook for channel: {channel.name}")
+                        webhook = await current_scheduler.get().request(channel_route("POST", channel, "/webhooks"),
+                            channel.create_webhook, name=webhook_username(WEBHOOK_NAME), reason="Migrating Slack messages")
+                except discord.HTTPException as e:
+                    log.error(f"Unable to use webhooks in channel: {channel.name}\n        {e}\n"
+                              f"        Messages will be sent by the bot, with a header naming the user")
+                self.webhooks[channel.id] = webhook
+            return self.webhooks[channel.id]
+
+
+webhooks = WebhookPool()
+
+
+class AttachmentCache:
+    """
+    Downloads slack files into an on-disk cache, so they can be uploaded to discord as real attachments.
+    Files are stored as <cache>/<slack file id>/<sha256 of content>/<name>, so a file shared in many
+    channels is only downloaded once, even when requested concurrently.
+    Downloads share one pooled HTTP session, with at most MAX_CONCURRENT_DOWNLOADS in flight.
+    """
+    def __init__(self, path, session=None, token=SLACK_TOKEN, concurrency=MAX_CONCURRENT_DOWNLOADS):
+        self.path = path
+        self.session = session
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.downloads = {} # slack file id -> future of its cached path
+        os.makedirs(path, exist_ok=True)
+
+    def cached_path(self, file_id):
+        """
+        :return: Path of the cached file, or None if it hasn't been downloaded
+        """
+        file_dir = os.path.join(self.path, file_id)
+        if os.path.isdir(file_dir):
+            for digest in os.listdir(file_dir):
+                names = os.listdir(os.path.join(file_dir, digest))
+                if names:
+                    return os.path.join(file_dir, digest, names[0])
+        return None
+
+    async def fetch(self, file):
+        """
+        Gets a slack file from the cache, downloading it if needed
+        :param file: Dict of the slack file, as found in a message's "files"
+        :return: Path of the cached file, or None if the download failed
+        """
+        file_id = file.get("id") or hashlib.sha256(file["url_private"].encode()).hexdigest()
+        if file_id not in self.downloads:
+            self.downloads[file_id] = asyncio.ensure_future(self._download(file_id, file))
+        return await self.downloads[file_id]
+
+    async def fetch_all(self, files):
+        """
+        Concurrently gets several slack files, see fetch()
+        :return: List of paths, with None for failed downloads
+        """
+        return await asyncio.gather(*[self.fetch(f) for f in files])
+
+    async def _download(self, file_id, file):
+        path = await run_blocking(self.cached_path, file_id)
+        if path:
+            return path
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        name = os.path.basename(file.get("name") or file.get("title") or file_id) or file_id
+        url = file.get("url_private_download") or file["url_private"]
+        tmp_path = os.path.join(self.path, f".{file_id}.part")
+        digest = hashlib.sha256()
+        try:
+            async with self.semaphore:
+                log.debug("Downloading file: %s", name)
+                async with self.session.get(url, headers=self.headers) as response:
+                    response.raise_for_status()
+                    if response.content_type == "text/html":
+                        # Slack serves its login page for files requiring a token
+                        raise aiohttp.ClientError("Received a web page instead of the file - is SLACK_TOKEN set?")
+                    f = await run_blocking(open, tmp_path, "wb")
+                    try:
+                        async for chunk in response.content.iter_chunked(1 << 16):
+                            digest.update(chunk)
+                            await run_blocking(f.write, chunk)
+                    finally:
+                        await run_blocking(f.close)
+            path = os.path.join(self.path, file_id, digest.hexdigest(), name)
+            await run_blocking(self.store, tmp_path, path)
+            return path
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            log.error(f"Unable to download file: {name}\n        {type(e).__name__}: {e}\n"
+                      f"        The file will be embedded as a link to slack instead", extra=summary("Unable to download file"))
+            await run_blocking(self.discard, tmp_path)
+            return None
+
+    @staticmethod
+    def store(tmp_path, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def discard(tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+
+async def download_attachments(records, attachments):
+    """
+    Starts downloading the files of upcoming messages in the background, while earlier messages are sent.
+    Downloads run as far ahead of the sender as the messages are queued (see prefetch()).
+    :param records: Async iterable of parsed messages, see parse_message()
+    :param attachments: AttachmentCache to download into
+    :return: Async generator of the parsed messages, with the future of their files' paths under "downloads"
+    """
+    async for record in records:
+        if record.get("attachments"):
+            record["downloads"] = asyncio.ensure_future(attachments.fetch_all(record["attachments"]))
+        yield record
+
+
+class ThreadManager:
+    """
+    Keeps imported threads open while they receive replies, rather than archiving them after every message.
+    Open threads are tracked as an LRU set shared by all channels being imported.
+    A thread is archived when evicted to stay within MAX_OPEN_THREADS, or once its channel is imported.
+    """
+    def __init__(self, max_open=MAX_OPEN_THREADS):
+        self.max_open = max_open
+        self.open = OrderedDict() # thread id -> (channel id, thread, scheduler of its bot), least recently used first
+
+    async def touch(self, thread, channel_id):
+        """
+        Marks a thread as open after a message was sent to it, archiving the least recently used threads if needed
+        :param thread: Thread that was sent to
+        :param channel_id: Id of the thread's parent channel
+        """
+        if thread.id in self.open:
+            self.open.move_to_end(thread.id)
+            return
+        self.open[thread.id] = (channel_id, thread, current_scheduler.get())
+        while len(self.open) > self.max_open:
+            _, (_, evicted, rate_limits) = self.open.popitem(last=False)
+            await self.archive(evicted, rate_limits)
+
+    async def close_channel(self, channel_id):
+        """
+        Archives the open threads of a channel
+        :param channel_id: Id of the parent channel
+        """
+        for thread_id, (parent_id, thread, rate_limits) in list(self.open.items()):
+            if parent_id == channel_id:
+                del self.open[thread_id]
+                await self.archive(thread, rate_limits)
+
+    async def close(self):
+        """
+        Archives all open threads
+        """
+        while self.open:
+            _, (_, thread, rate_limits) = self.open.popitem(last=False)
+            await self.archive(thread, rate_limits)
+
+    @staticmethod
+    async def archive(thread, rate_limits=scheduler):
+        """
+        :param thread: Thread to archive
+        :param rate_limits: Scheduler of the bot the thread was created by
+        """
+        try:
+            await rate_limits.request(channel_route("PATCH", thread), thread.edit, archived=True)
+        except discord.HTTPException as e:
+            log.error(f"Unable to archive thread: {thread.name}\n        {e}")
+
+
+class ImportJournal:
+    """
+    Durable record of what has been imported, so an interrupted import can be resumed without duplicates.
+    Maps each imported (guild, channel, slack ts) to its discord message id,
+    and each (guild, channel, thread_ts) to its discord thread (or thread-owner message if discord.py < 2.0).
+    Every entry is committed as soon as its message is sent.
+    Also keeps the high-water mark of each channel and thread: the latest ts imported into it,
+    which incremental imports skip everything up to.
+    Imports call it through run_blocking(), so its disk I/O stays off the event loop, one call at a time.
+    """
+    def __init__(self, path, advance_marks=True):
+        """
+        :param path: Path to the journal's database, or ":memory:"
+        :param advance_marks: Whether recorded messages advance the high-water marks,
+                              which imports that leave out older messages must not do
+        """
+        self.path = path
+        self.advance_marks = advance_marks
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS messages (
+                guild INTEGER, channel TEXT, ts TEXT, message_id INTEGER,
+                PRIMARY KEY (guild, channel, ts));
+            CREATE TABLE IF NOT EXISTS threads (
+                guild INTEGER, channel TEXT, thread_ts TEXT, thread_id INTEGER,
+                PRIMARY KEY (guild, channel, thread_ts));
+            CREATE TABLE IF NOT EXISTS marks (
+                guild INTEGER, channel TEXT, thread_ts TEXT, ts REAL,
+                PRIMARY KEY (guild, channel, thread_ts));
+        """)
+
+    def is_imported(self, guild, channel, ts):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM messages WHERE guild = ? AND channel = ? AND ts = ?",
+                                  (guild, channel, ts)).fetchone()
+        return row is not None
+
+    def record_messages(self, guild, channel, ts_list, message_id, thread_ts=None):
+        """
+        Records the slack messages sent as one discord message, e.g. when coalesced, in one commit
+        :param ts_list: List of the ts of the slack messages
+        :param thread_ts: ts of the thread the messages belong to (or own), if any
+        """
+        with self.lock, self.db:
+            for ts in ts_list:
+                self.db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)", (guild, channel, ts, message_id))
+                if not self.advance_marks:
+                    continue
+                # Messages owning a thread advance the mark of the channel, and replies the mark of their thread
+                mark = thread_ts if thread_ts and thread_ts != ts else ""
+                self.db.execute("INSERT OR IGNORE INTO marks VALUES (?, ?, ?, ?)", (guild, channel, mark, float(ts)))
+                self.db.execute("UPDATE marks SET ts = ? WHERE guild = ? AND channel = ? AND thread_ts = ? AND ts < ?",
+                                (float(ts), guild, channel, mark, float(ts)))
+
+    def get_marks(self, guild, channel):
+        """
+        :return: Dictionary of thread_ts (or "" for the channel itself) => latest ts imported into it
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT thread_ts, ts FROM marks WHERE guild = ? AND channel = ?", (guild, channel))
+            return dict(rows.fetchall())
+
+    def get_threads(self, guild, channel):
+        """
+        :return: Dictionary of thread_ts => discord id of the thread (or thread-owner message)
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT thread_ts, thread_id FROM threads WHERE guild = ? AND channel = ?",
+                                   (guild, channel))
+            return dict(rows.fetchall())
+
+    def record_thread(self, guild, channel, thread_ts, thread_id):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?)", (guild, channel, thread_ts, thread_id))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class DeadLetters:
+    """
+    Messages that failed to send (after their retries), appended to a JSON-lines file in the slack-root,
+    one {"time", "guild", "channel", "ts", "thread", "error"} object per slack message.
+    Importing with --dead-letters selects only these messages from the index, to import them again without
+    re-reading the rest of the export. Messages are dropped from the file once the journal records them imported.
+    """
+    def __init__(self, path=None):
+        self.path = path # None keeps them in memory only, e.g. for a dry-run
+
+    def add(self, guild, channel, record, error):
+        """
+        :param guild: Id of the server the message was imported into
+        :param channel: Name of the slack channel of the message
+        :param record: Parsed message that failed, see parse_message()
+        :param error: Exception it failed with
+        """
+        if not self.path:
+            return
+        entries = [{"time": time.time(), "guild": guild, "channel": channel, "ts": ts, "thread": record["thread"],
+                    "error": f"{type(error).__name__}: {error}"}
+                   for ts in filter(None, [record["ts"]] + record.get("coalesced", []))]
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in entries)
+        except OSError as e:
+            log.error(f"Unable to record failed message in the dead letters: {e}")
+
+    def load(self):
+        """
+        :return: List of the dead letters
+        """
+        if not self.path or not os.path.isfile(self.path):
+            return []
+        entries = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    log.warning(f"Skipping unreadable line of the dead letters: {line.strip()}")
+        return entries
+
+    def select(self, guild):
+        """
+        :param guild: Id of the server
+        :return: Dict of channel => list of the ts of its dead letters into the server
+        """
+        selected = {}
+        for entry in self.load():
+            if entry["guild"] == guild and entry["ts"] not in selected.get(entry["channel"], []):
+                selected.setdefault(entry["channel"], []).append(entry["ts"])
+        return selected
+
+    def prune(self, journal):
+        """
+        Drops the dead letters of messages the journal records as imported, and duplicates of the same message
+        :param journal: ImportJournal
+        :return: Number of dead letters left
+        """
+        entries = self.load()
+        if not entries:
+            return 0
+        left = {}
+        for entry in entries:
+            if not journal.is_imported(entry["guild"], entry["channel"], entry["ts"]):
+                left[(entry["guild"], entry["channel"], entry["ts"])] = entry # the latest error of a message is kept
+        if len(left) < len(entries):
+            try:
+                with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                    f.writelines(json.dumps(entry) + "\n" for entry in left.values())
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                log.error(f"Unable to update the dead letters: {e}")
+        return len(left)
+
+
+class MessageStore:
+    """
+    Local index of the messages in a slack-log directory, so imports select their messages with
+    queries rather than re-reading every .json log.
+    Messages are stored as their raw json, indexed by channel, ts, thread_ts and user.
+    A .json log is only (re-)indexed when its size or modification time has changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.selected = {} # channel -> [path_json_logs] queries read from, see index()
+        # Indexing runs in a background thread of run_blocking(), before any query.
+        #  Channels are queried concurrently, so every query() and count() opens its own connection.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, channel TEXT, size INTEGER, mtime INTEGER);
+            CREATE TABLE IF NOT EXISTS messages (
+                channel TEXT, ts REAL, thread_ts REAL, user TEXT, file TEXT, raw TEXT);
+            CREATE INDEX IF NOT EXISTS messages_channel_ts ON messages (channel, ts);
+            CREATE INDEX IF NOT EXISTS messages_channel_thread ON messages (channel, thread_ts, ts);
+            CREATE INDEX IF NOT EXISTS messages_user ON messages (user, ts);
+            CREATE INDEX IF NOT EXISTS messages_file ON messages (file);
+        """)
+
+    def index(self, history):
+        """
+        Indexes the .json logs of the given channels, and selects them as the logs later queries read from
+        :param history: Dict of the form {"channel": [path_json_logs]}
+        """
+        self.selected = {}
+        for channel, fs in history.items():
+            for json_file in fs:
+                try:
+                    size, mtime = export_stat(json_file)
+                except OSError as e:
+                    log.error(f"{e}")
+                    continue
+                self.selected.setdefault(channel, []).append(json_file)
+                row = self.db.execute("SELECT size, mtime FROM files WHERE path = ?", (json_file,)).fetchone()
+                if row == (size, mtime):
+                    continue
+                log.info(f"Indexing file: {json_file}")
+                try:
+                    with self.db:
+                        self.db.execute("DELETE FROM messages WHERE file = ?", (json_file,))
+                        self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", (
+                            (channel, float(m["ts"]) if "ts" in m else None,
+                             float(m["thread_ts"]) if "thread_ts" in m else None,
+                             m.get("user"), json_file, json.dumps(m))
+                            for m in iter_json_array(json_file)))
+                        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                        (json_file, channel, size, mtime))
+                except OSError as e:
+                    log.error(f"{e}")
+                except json.JSONDecodeError as e:
+                    log.error(f"Unable to load json-file, skipping.\n  JSONDecodeError: {e}")
+
+    def query(self, channel, since=None, until=None, user=None, threads_only=False, group_threads=False, ts_in=None, raw=False):
+        """
+        Yields the messages of a channel from the selected .json logs, in chronological order
+        :param channel: Name of the channel
+        :param since: Only messages sent at or after this unix time
+        :param until: Only messages sent before this unix time
+        :param user: Only messages sent by this user id
+        :param threads_only: Only messages that own or belong to a thread
+        :param group_threads: Order thread replies directly after their parent, even if sent days later
+        :param ts_in: Only the messages with these slack timestamps
+        :param raw: Yield the messages as their json strings, leaving them to be decoded by the parse pool
+        :return: Generator of message dicts
+        """
+        sql, params = self._select("SELECT raw", channel, since, until, user, threads_only, ts_in)
+        sql += " ORDER BY COALESCE(thread_ts, ts), ts" if group_threads else " ORDER BY ts"
+        # The generator may be resumed from another thread, though only by one consumer at a time
+        db = self._connect(channel, ts_in)
+        try:
+            for (message,) in db.execute(sql, params):
+                yield message if raw else json.loads(message)
+        finally:
+            db.close()
+
+    def count(self, channel, since=None, until=None, user=None, threads_only=False, group_threads=False, ts_in=None):
+        """
+        :return: Number of messages query() yields with the same arguments
+        """
+        sql, params = self._select("SELECT COUNT(*)", channel, since, until, user, threads_only, ts_in)
+        db = self._connect(channel, ts_in)
+        try:
+            return db.execute(sql, params).fetchone()[0]
+        finally:
+            db.close()
+
+    def _connect(self, channel, ts_in):
+        """
+        :return: New connection to the index, with the channel's selected logs and the wanted ts_in in temp tables
+        """
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        with db:
+            db.executescript("""
+                CREATE TEMP TABLE selected (channel TEXT, path TEXT, PRIMARY KEY (channel, path));
+                CREATE TEMP TABLE wanted (channel TEXT, ts REAL);
+            """)
+            db.executemany("INSERT OR IGNORE INTO selected VALUES (?, ?)",
+                           ((channel, json_file) for json_file in self.selected.get(channel, ())))
+            if ts_in is not None:
+                db.executemany("INSERT INTO wanted VALUES (?, ?)", ((channel, float(ts)) for ts in ts_in))
+        return db
+
+    def _select(self, select, channel, since, until, user, threads_only, ts_in):
+        sql = (select + " FROM messages JOIN selected ON messages.file = selected.path AND messages.channel = selected.channel"
+               " WHERE messages.channel = ?")
+        params = [channel]
+        if since is not None:
+            sql += " AND ts >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND ts < ?"
+            params.append(until)
+        if user is not None:
+            sql += " AND user = ?"
+            params.append(user)
+        if threads_only:
+            sql += " AND thread_ts IS NOT NULL"
+        if ts_in is not None:
+            sql += " AND ts IN (SELECT ts FROM wanted WHERE wanted.channel = messages.channel)"
+        return sql, params
+
+    def close(self):
+        self.db.close()
+
+
+class ExportManifest:
+    """
+    Listing of a slack export: the .json files in its root and in each of its (channel) directories,
+    with their sizes and mtimes, built with os.scandir rather than per-file listdir/stat calls.
+    The manifest is saved in the slack-root, and a directory is only listed again when its mtime changed,
+    so re-opening an unchanged export only lists the root.
+    Note that editing a file in place does not change its directory's mtime, so it is not picked up.
+    Exports within a .zip file are instead listed from its central directory, and not saved.
+    """
+    # Manifests already opened by this process, by root
+    cache = {}
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self.archive, self.prefix = split_archive_path(root)
+        self.dirs = {} # directory name ("" for the root) -> {"mtime": ns, "files": [[name, size, mtime]]}
+
+    @classmethod
+    def open(cls, root):
+        """
+        Loads the manifest of an export, refreshing and saving it if its directories changed
+        :param root: Path to the slack-root
+        :return: ExportManifest
+        """
+        root = os.path.normpath(root)
+        manifest = cls.cache.get(root)
+        if manifest is None:
+            manifest = cls.cache[root] = cls(root)
+            if manifest.archive:
+                manifest.list_archive()
+                return manifest
+            try:
+                with open(manifest.path, encoding="utf-8") as f:
+                    manifest.dirs = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if manifest.archive:
+            manifest.list_archive()
+        elif manifest.refresh():
+            try:
+                with open(manifest.path, "w", encoding="utf-8") as f:
+                    json.dump(manifest.dirs, f)
+            except OSError as e:
+                log.warning(f"Unable to save export manifest: {e}")
+        return manifest
+
+    @staticmethod
+    def scan(path):
+        """
+        :param path: Path to a directory
+        :return: Tuple of the .json files in the directory as a sorted list of [name, size, mtime],
+                 and a dict of its subdirectories' names => mtimes, leaving out the directories of slack2discord
+        """
+        files, subdirs = [], {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.name.startswith(STATE_PREFIX):
+                        subdirs[entry.name] = entry.stat().st_mtime_ns
+                elif entry.name.endswith(".json") and entry.name != MANIFEST_NAME and entry.is_file():
+                    stat = entry.stat()
+                    files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+        return sorted(files), subdirs
+
+    def refresh(self):
+        """
+        Lists the root, and any directories that were added or changed since the manifest was built
+        :return: Whether the manifest changed
+        """
+        files, subdirs = self.scan(self.root)
+        dirs = {"": {"files": files}} # the root is listed every time, to find the changed directories
+        for name, mtime in subdirs.items():
+            known = self.dirs.get(name)
+            if known and known["mtime"] == mtime:
+                dirs[name] = known
+            else:
+                dirs[name] = {"mtime": mtime, "files": self.scan(os.path.join(self.root, name))[0]}
+        changed = dirs != self.dirs
+        self.dirs = dirs
+        return changed
+
+    def list_archive(self):
+        """
+        Lists the .json files of the export from the central directory of its .zip file
+        """
+        prefix = self.prefix + "/" if self.prefix else ""
+        dirs = {"": {"files": []}}
+        for info in get_archive(self.archive).infolist():
+            if not info.filename.startswith(prefix):
+                continue
+            d, _, name = info.filename[len(prefix):].rstrip("/").rpartition("/")
+            if info.is_dir():
+                if name and not d:
+                    dirs.setdefault(name, {"mtime": None, "files": []})
+            elif "/" not in d and name.endswith(".json"):
+                dirs.setdefault(d, {"mtime": None, "files": []})["files"].append([name, info.file_size, get_archive_mtime(info)])
+        for listing in dirs.values():
+            listing["files"].sort()
+        self.dirs = dirs
+
+    def has_file(self, name):
+        return any(f[0] == name for f in self.dirs[""]["files"])
+
+    def channels(self):
+        """
+        :return: Names of the directories in the root, in sorted order, leaving out the directories of slack2discord
+        """
+        return sorted(name for name in self.dirs if name and not name.startswith(STATE_PREFIX))
+
+    def logs(self, name):
+        """
+        :param name: Name of a directory in the root, or "" for the root itself
+        :return: Sorted paths to the .json logs in the directory, leaving out the files of slack2discord
+        """
+        path = os.path.join(self.root, name) if name else self.root
+        return [os.path.join(path, f[0]) for f in self.log_files(name)]
+
+    def size(self, name):
+        """
+        :param name: Name of a directory in the root, or "" for the root itself
+        :return: Total bytes of the .json logs in the directory
+        """
+        return sum(f[1] for f in self.log_files(name))
+
+    def log_files(self, name):
+        return [f for f in self.dirs.get(name, {"files": []})["files"] if not f[0].startswith(STATE_PREFIX)]
+
+
+class ParsePool:
+    """
+    Parses slack messages into send-ready records in worker processes, ahead of the sender.
+    Work is handed out in batches of PARSE_BATCH messages, streamed from a .json log or selected from the index,
+    and a few batches per channel are parsed ahead while the previous ones are sent,
+    so no more than those batches of a channel are held in memory, however large its logs.
+    Records logged by the workers are forwarded to the handlers of this process.
+    """
+    def __init__(self, users, avatars, references, processes=PARSE_PROCESSES):
+        context = {"users": users, "avatars": avatars, "references": references}
+        # Workers each hold a copy of the references, so their warnings are logged here, once
+        self.references = references
+        self.ahead = max(1, processes)
+        self.listener = None
+        if processes:
+            # Spawned rather than forked, as forking the running bot's threads is unsafe
+            log_queue = multiprocessing.get_context("spawn").Queue()
+            self.listener = logging.handlers.QueueListener(log_queue, *log.handlers, respect_handler_level=True)
+            self.listener.start()
+            self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=init_parse_worker, initargs=(context, log_queue, log.level))
+            self.prepare = prepare_messages
+        else:
+            self.executor = ThreadPoolExecutor(1)
+            self.prepare = functools.partial(prepare_messages, context=context)
+
+    async def records(self, sources, skip=None):
+        """
+        Parses sources in the pool, yielding their records in order
+        :param sources: Iterable of paths to .json logs, or lists of messages as json strings
+        :param skip: Function of a parsed message, returning whether it was already imported
+        :return: Async generator of parsed messages, see prepare_messages()
+        """
+        pending = deque()
+        sources = self.batches(sources)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.ahead:
+                    # Sources may be read from the index, so they're also pulled off the event loop
+                    source = await run_blocking(next, sources, None)
+                    if source is None:
+                        exhausted = True
+                    else:
+                        pending.append(asyncio.wrap_future(self.executor.submit(self.prepare, source)))
+                if not pending:
+                    return
+                records, used = await pending.popleft()
+                if self.references is not None:
+                    warn_references(self.references, used)
+                if skip:
+                    records = await run_blocking(skip_records, records, skip)
+                for record in records:
+                    yield record
+        finally:
+            for future in pending:
+                future.cancel()
+
+    @staticmethod
+    def batches(sources):
+        """
+        :param sources: Iterable of paths to .json logs, or lists of messages as json strings
+        :return: Generator of lists of at most PARSE_BATCH messages, as dicts streamed from the logs or json strings
+        """
+        for source in sources:
+            if isinstance(source, str):
+                yield from batch_messages(iter_messages([source]))
+            else:
+                yield source
+
+    def close(self):
+        self.executor.shutdown()
+        if self.listener:
+            self.listener.stop()
+
+
+class PlanReader:
+    """
+    Reads an import plan (see compile_plan()): a JSON-lines file starting with a "plan" header holding the lookup
+    tables it was compiled with, followed by blocks of send-ready "message" lines, each block between a "channel"
+    line and an "end" line counting its slack messages (including coalesced ones) and listing the users they mention.
+    A block without an end was cut short, and is ignored.
+    It stands in for the ParsePool of an import, yielding the records of a channel's blocks with only their
+    references filled in, so replaying a plan does no parsing.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.blocks = {} # channel -> list of (start, end) byte offsets of its blocks
+        self.counts = {} # channel -> number of messages in its blocks
+        self.mentions = set() # user ids mentioned by the blocks
+        self.channels = {} # (start, end) byte offsets of a block -> its channel
+        self.wanted = None # channel -> set of the ts of the only messages to import, see select()
+        self.references = None
+
+    @staticmethod
+    def is_plan(path):
+        """
+        :param path: Path to a file or directory
+        :return: Whether it is an import plan
+        """
+        try:
+            with open(path, "rb") as f:
+                return f.readline(64).startswith(b'{"op": "plan"')
+        except OSError:
+            return False
+
+    def scan(self):
+        """
+        Reads the header, and locates the channels' blocks without decoding their messages
+        :return: self
+        :raises OSError: If the plan can not be read
+        :raises ValueError: If it is not a plan of this version
+        """
+        self.blocks, self.counts, self.mentions, self.channels = {}, {}, set(), {}
+        channel, start = None, 0
+        with open(self.path, "rb") as f:
+            self.header = json.loads(f.readline())
+            if self.header.get("op") != "plan" or self.header.get("version") != PLAN_VERSION:
+                raise ValueError(f"Not an import plan of version {PLAN_VERSION}: {self.path}")
+            offset = f.tell()
+            for line in f:
+                if line.startswith(b'{"op": "channel"'):
+                    channel, start = json.loads(line)["name"], offset + len(line)
+                elif line.startswith(b'{"op": "end"') and channel is not None:
+                    end = json.loads(line)
+                    self.blocks.setdefault(channel, []).append((start, offset))
+                    self.channels[(start, offset)] = channel
+                    self.counts[channel] = self.counts.get(channel, 0) + end["messages"]
+                    self.mentions.update(end["mentions"])
+                    channel = None
+                offset += len(line)
+        return self
+
+    def slack_dir(self):
+        """
+        :return: Dict representing the plan as a slack-log directory, see locate_slack_directory()
+        """
+        state = self.header["state"] if os.path.isdir(self.header["state"]) else os.path.dirname(os.path.abspath(self.path))
+        return {"root_files": {}, "history": dict(self.blocks),
+                "sizes": {ch: sum(end - start for start, end in blocks) for ch, blocks in self.blocks.items()},
+                "root": self.header["root"], "state": state, "plan": self}
+
+    def select(self, ts_in):
+        """
+        Only imports the messages with the given slack timestamps, such as the dead letters (see DeadLetters.select())
+        :param ts_in: Dict of channel => list of the ts of its messages to import
+        """
+        self.wanted = {ch: set(ts) for ch, ts in ts_in.items()}
+
+    def read(self, blocks):
+        """
+        :param blocks: List of (start, end) byte offsets of blocks
+        :return: Generator of lists of records, up to PLAN_BATCH at a time
+        """
+        with open(self.path, "rb") as f:
+            for start, end in blocks:
+                wanted = self.wanted.get(self.channels[(start, end)], set()) if self.wanted is not None else None
+                f.seek(start)
+                batch = []
+                while f.tell() < end:
+                    record = self.record(f.readline())
+                    if wanted is not None and record["ts"] not in wanted:
+                        continue
+                    batch.append(record)
+                    if len(batch) >= PLAN_BATCH:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+
+    def record(self, line):
+        """
+        :param line: "message" line of the plan
+        :return: Record ready to be sent, see parse_message()
+        """
+        record = json.loads(line)
+        record["files"] = [discord.Embed.from_dict(e) for e in record.pop("embeds")] or None
+        record["msg"] = fill_references(record["msg"], self.references)
+        return record
+
+    async def records(self, sources, skip=None):
+        """
+        :param sources: Iterable of (start, end) byte offsets of blocks, in order
+        :param skip: Function of a record, returning whether it was already imported
+        :return: Async generator of records, see ParsePool.records()
+        """
+        batches = self.read(list(sources))
+        while True:
+            # Decoded in the background, like the parse pool's work
+            batch = await run_blocking(next, batches, None)
+            if batch is None:
+                return
+            if skip:
+                batch = await run_blocking(skip_records, batch, skip)
+            for record in batch:
+                yield record
+
+    def close(self):
+        pass
+
+
+class DryRunTransport:
+    """
+    Local stand-in for discord, used to run an import without a network or a server.
+    Records every request the import would make, and simulates discord's per-route rate limits
+    on a virtual clock to estimate how long the import would take.
+    Each channel (with its threads) is a "lane" of sequential requests, and lanes are
+    spread over the import workers the same way import_slack_directory does.
+    """
+    def __init__(self, latency=DRY_RUN_LATENCY_SECONDS, rate_limit=DRY_RUN_RATE_LIMIT, workers=IMPORT_WORKERS):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.workers = workers
+        self.requests = [] # (method, path) of every request, in order
+        self.counts = {} # kind of request -> count
+        self.lanes = {} # lane -> virtual time its last request completed
+        self.windows = {} # route -> deque of virtual start times within the current window
+        self.rate_limited = 0
+        self.rate_limited_seconds = 0.0
+        # Snowflake-sized, so the scheduler normalizes them in routes like real ids
+        self.ids = iter(range(1 << 60, 1 << 63))
+
+    def next_id(self):
+        return next(self.ids)
+
+    @staticmethod
+    def message_kind(content, kind):
+        # Messages the bot had to split off from the original one
+        if str(content).startswith(("*continuation:*", "*Additional attachments:*")):
+            return "messages split"
+        return kind
+
+    def request(self, method, path, kind, lane):
+        """
+        Records a request, advancing the virtual clock of its lane
+        :param method: HTTP method of the request
+        :param path: URL path of the request
+        :param kind: Kind of request, counted in the report (e.g. "messages sent")
+        :param lane: Id of the channel whose sequence of requests this belongs to
+        """
+        self.requests.append((method, path))
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        route = RateLimitScheduler.route_key(method, path)
+        limit, per = self.rate_limit
+        window = self.windows.setdefault(route, deque())
+        start = self.lanes.get(lane, 0.0)
+        while window and window[0] <= start - per:
+            window.popleft()
+        if len(window) >= limit:
+            # Discord would respond 429, with the time until the oldest request leaves the window
+            retry_after = window[0] + per - start
+            self.rate_limited += 1
+            self.rate_limited_seconds += retry_after
+            start += retry_after
+            window.popleft()
+        window.append(start)
+        self.lanes[lane] = start + self.latency
+
+    def estimate(self):
+        """
+        Estimates the wall-clock time of the recorded import
+        :return: Seconds
+        """
+        workers = [0.0] * max(1, self.workers)
+        for duration in self.lanes.values():
+            workers[workers.index(min(workers))] += duration
+        return max(max(workers), len(self.requests) / GLOBAL_RATE_LIMIT)
+
+    def report(self):
+        lines = [f"Dry-run complete - no requests were sent to discord",
+                 f"       API calls: {len(self.requests)}"]
+        lines += [f"         {kind}: {count}" for kind, count in sorted(self.counts.items())]
+        lines += [f"       Rate-limited: {self.rate_limited} times, waiting {timedelta(seconds=round(self.rate_limited_seconds))}",
+                  f"       Estimated wall-clock time: {timedelta(seconds=round(self.estimate()))}"]
+        log.info("\n".join(lines))
+
+
+class DryRunMessage:
+    def __init__(self, transport, channel, content):
+        self.transport = transport
+        self.id = transport.next_id()
+        self.channel = channel
+        self.content = content
+
+    async def create_thread(self, name, reason=None):
+        self.transport.request("POST", f"/channels/{self.channel.id}/messages/{self.id}/threads", "threads created", self.channel.id)
+        return DryRunChannel(self.transport, self.channel.guild, name, parent=self.channel)
+
+
+class DryRunWebhook:
+    def __init__(self, transport, channel):
+        self.transport = transport
+        self.id = transport.next_id()
+        self.name = webhook_username(WEBHOOK_NAME)
+        self.token = "dry-run"
+        self.channel = channel
+
+    async def send(self, content=None, username=None, avatar_url=None, wait=False, thread=None, **kwargs):
+        kind = self.transport.message_kind(content, "messages sent (webhook)")
+        self.transport.request("POST", f"/webhooks/{self.id}", kind, self.channel.id)
+        return DryRunMessage(self.transport, thread or self.channel, content)
+
+
+class DryRunChannel:
+    """
+    Stand-in for a TextChannel, or a Thread if it has a parent
+    """
+    def __init__(self, transport, guild, name, parent=None):
+        self.transport = transport
+        self.id = transport.next_id()
+        self.guild = guild
+        self.name = name
+        self.parent = parent
+        self.mention = f"<#{self.id}>"
+        self.type = discord.ChannelType.public_thread if parent and discord.__version__[0] >= "2" else discord.ChannelType.text
+        self.webhook = None
+
+    @property
+    def lane(self):
+        return self.parent.id if self.parent else self.id
+
+    async def send(self, content=None, **kwargs):
+        kind = self.transport.message_kind(content, "messages sent")
+        self.transport.request("POST", f"/channels/{self.id}/messages", kind, self.lane)
+        return DryRunMessage(self.transport, self, content)
+
+    async def edit(self, **kwargs):
+        self.transport.request("PATCH", f"/channels/{self.id}", "channels edited", self.lane)
+        return self
+
+    async def fetch_message(self, message_id):
+        self.transport.request("GET", f"/channels/{self.id}/messages/{message_id}", "messages fetched", self.lane)
+        return DryRunMessage(self.transport, self, None)
+
+    async def webhooks(self):
+        self.transport.request("GET", f"/channels/{self.id}/webhooks", "webhooks fetched", self.lane)
+        return [self.webhook] if self.webhook else []
+
+    async def create_webhook(self, name, reason=None):
+        self.transport.request("POST", f"/channels/{self.id}/webhooks", "webhooks created", self.lane)
+        self.webhook = DryRunWebhook(self.transport, self)
+        return self.webhook
+
+
+class DryRunGuild:
+    def __init__(self, transport, name="dry-run"):
+        self.transport = transport
+        self.id = transport.next_id()
+        self.name = name
+        self.filesize_limit = 8 * 1024 * 1024
+        self.channels = []
+        self.members = []
+
+    def get_member_named(self, name):
+        return None
+
+    def get_thread(self, thread_id):
+        return None
+
+    async def fetch_channel(self, channel_id):
+        self.transport.request("GET", f"/channels/{channel_id}", "channels fetched", channel_id)
+        return None
+
+    async def fetch_channels(self):
+        self.transport.request("GET", f"/guilds/{self.id}/channels", "channels fetched", "guild")
+        return list(self.channels)
+
+    async def create_text_channel(self, name, reason=None):
+        self.transport.request("POST", f"/guilds/{self.id}/channels", "channels created", "guild")
+        channel = DryRunChannel(self.transport, self, name)
+        self.channels.append(channel)
+        return channel
+
+
+class DryRunContext:
+    """
+    Stand-in for the context of an import command, invoked from a channel of a dry-run guild
+    """
+    def __init__(self, transport):
+        self.guild = DryRunGuild(transport)
+        self.channel = DryRunChannel(transport, self.guild, "dry-run")
+        self.guild.channels.append(self.channel)
+        self.send = self.channel.send
+
+
+def channel_route(method, ctx, endpoint=""):
+    """
+    Builds the rate-limit route key for a request against a channel, thread or command context
+    :param method: HTTP method of the request
+    :param ctx: Context, channel or thread the request targets
+    :param endpoint: Path following the channel, such as "/messages"
+    :return: String route key
+    """
+    channel = getattr(ctx, "channel", None) or ctx
+    return RateLimitScheduler.route_key(method, f"/channels/{channel.id}{endpoint}")
 
 
 def check_optional_dependencies():
-    print(f"[INFO] Checking (optional) dependency versions:")
+    log.info(f"Checking (optional) dependency versions:")
     if discord.__version__[0] < "2":
         # Pre discord.py v2.0 the bot can only give messages 1 embed,
         #  so has to be split into multiple messages.
@@ -36,22 +1709,14 @@ def check_optional_dependencies():
         # discord.py v2.0 also increased the package's requirements,
         #  requiring a higher python version.
         # It is thus treated as optional.
-        print(f"[WARNING] discord.py version < 2.0, currently using version: {discord.__version__}")
-        print(f"          Some features are unsupported with current version:")
-        print(f"          * Unable to create Threads")
-        print(f"            - Messages will be sent directly to the owner's TextChannel instead.")
-        print(f"          * Messages are unable to contain more than 1 Embed each")
-        print(f"            - Multiple attachments they will be split into multiple messages,")
-        print(f"               linking to their 'parent' message.")
-        print(f"          Upgrade discord.py to >= 2.0 to enable those features.")
+        log.warning(f"discord.py version < 2.0, currently using version: {discord.__version__}\n          Some features are unsupported with current version:\n          * Unable to create Threads\n            - Messages will be sent directly to the owner's TextChannel instead.\n          * Messages are unable to contain more than 1 Embed each\n            - Multiple attachments they will be split into multiple messages,\n               linking to their 'parent' message.\n          Upgrade discord.py to >= 2.0 to enable those features.")
         
         if sys.version_info[1] < 8:
-            print(f"[INFO] Current python version does not satisfy discord.py v2.0 dependency. Current: {'.'.join(map(str, sys.version_info[:3]))}")
-            print(f"       You will be unable to upgrade discord.py to v2.0,")
-            print(f"        unless you first upgrade python to >= 3.8")
+            log.info(f"Current python version does not satisfy discord.py v2.0 dependency. Current: {'.'.join(map(str, sys.version_info[:3]))}\n       You will be unable to upgrade discord.py to v2.0,\n        unless you first upgrade python to >= 3.8")
     else:
-        print(f"       All features enabled! - No dependencies unsatisfied")
-    print(f"")
+        log.info(f"All features enabled! - No dependencies unsatisfied")
+    if ijson is None:
+        log.info(f"ijson is not installed - .json logs are streamed with the (slower) standard library parser\n       Install it with `pip install ijson` to speed up parsing of large logs")
 
 
 def get_basename(file_path):
@@ -65,19 +1730,231 @@ def get_filename(file_path):
     return get_basename(os.path.splitext(file_path)[0])
 
 
+# Open .zip exports, by path -> ((size, mtime), zipfile.ZipFile)
+archives = {}
+
+
+def split_archive_path(path):
+    """
+    Splits a path pointing into a .zip export, such as "export.zip/general/2021-01-01.json"
+    :param path: String path
+    :return: Tuple of the path to the .zip file and the name of the member within it ("" for the .zip itself),
+             or (None, path) if the path does not point into a .zip file
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    for i, part in enumerate(parts):
+        if part.lower().endswith(".zip"):
+            archive = os.sep.join(parts[:i + 1])
+            if os.path.isfile(archive):
+                return archive, "/".join(parts[i + 1:])
+    return None, path
+
+
+def get_archive(path):
+    """
+    Opens a .zip export, reading its central directory once for as long as the file is unchanged
+    :param path: Path to the .zip file
+    :return: zipfile.ZipFile
+    """
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    if path not in archives or archives[path][0] != key:
+        archives[path] = (key, zipfile.ZipFile(path))
+    return archives[path][1]
+
+
+def get_archive_info(path):
+    """
+    :param path: String path
+    :return: zipfile.ZipInfo of the file if the path points at a file within a .zip export, otherwise None
+    """
+    archive, member = split_archive_path(path)
+    if archive is None or not member:
+        return None
+    try:
+        return get_archive(archive).getinfo(member)
+    except KeyError:
+        return None
+
+
+def get_archive_mtime(info):
+    """
+    :param info: zipfile.ZipInfo of a file within a .zip export
+    :return: The file's mtime in nanoseconds, as recorded in the .zip file (local time, 2 second resolution)
+    """
+    return int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+
+
+def export_isfile(path):
+    """
+    :param path: String path to a file, which may be within a .zip export
+    :return: Whether the file exists
+    """
+    if split_archive_path(path)[0] is None:
+        return os.path.isfile(path)
+    return get_archive_info(path) is not None
+
+
+def export_stat(path):
+    """
+    :param path: String path to a file, which may be within a .zip export
+    :return: Tuple of the file's size and mtime (in nanoseconds)
+    :raises OSError: If the file does not exist
+    """
+    if split_archive_path(path)[0] is None:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    info = get_archive_info(path)
+    if info is None:
+        raise FileNotFoundError(f"No such file in archive: '{path}'")
+    return info.file_size, get_archive_mtime(info)
+
+
+def open_export_file(path, binary=False):
+    """
+    Opens a file for reading, streaming it straight from the archive if within a .zip export
+    :param path: String path to the file
+    :param binary: Open in binary mode, rather than as utf-8 text
+    :return: File object
+    :raises OSError: If the file can not be read
+    """
+    archive, member = split_archive_path(path)
+    if archive is None:
+        return open(path, "rb") if binary else open(path, encoding="utf-8")
+    if get_archive_info(path) is None:
+        raise FileNotFoundError(f"No such file in archive: '{path}'")
+    f = get_archive(archive).open(member)
+    return f if binary else io.TextIOWrapper(f, encoding="utf-8")
+
+
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _iter_json_array_stdlib(f):
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    expect = "["
+    while True:
+        # Skip whitespace, refilling the buffer as it runs out
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                break
+            chunk = f.read(JSON_READ_SIZE)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+        if pos >= len(buf):
+            raise json.JSONDecodeError("Unexpected end of file", buf, pos)
+
+        char = buf[pos]
+        if expect == "[":
+            if char != "[":
+                raise json.JSONDecodeError("Expecting top-level array", buf, pos)
+            pos += 1
+            expect = "value or ]"
+        elif char == "]" and expect != "value":
+            return
+        elif expect == ", or ]":
+            if char != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+            pos += 1
+            expect = "value"
+        else:
+            # Decode the next element, reading more until it is complete.
+            #  A number cut off by the end of the buffer decodes "successfully", so the element must also be
+            #  followed by a delimiter to be known complete.
+            read_size = JSON_READ_SIZE
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    if eof or (end < len(buf) and buf[end] in " \t\n\r,]"):
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                chunk = f.read(read_size)
+                read_size *= 2 # grow reads so huge elements are not re-decoded once per chunk
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+            pos = end
+            expect = ", or ]"
+            yield value
+
+
+def iter_json_array(file_path):
+    """
+    Incrementally yields the elements of the top-level array in a .json file,
+    so only one element at a time is held in memory.
+    Uses ijson if installed, otherwise json.JSONDecoder.raw_decode over a buffered reader.
+    :param file_path: String path to the .json file
+    :return: Generator of the decoded elements
+    :raises OSError: If the file can not be read
+    :raises json.JSONDecodeError: If the file is not a valid json array
+    """
+    if ijson is not None:
+        with open_export_file(file_path, binary=True) as f:
+            try:
+                yield from ijson.items(f, "item", use_float=True)
+            except ijson.JSONError as e:
+                raise json.JSONDecodeError(str(e), "", 0) from e
+    else:
+        with open_export_file(file_path) as f:
+            yield from _iter_json_array_stdlib(f)
+
+
+def confirm(question):
+    """
+    Asks the user a yes/no question on the terminal, unless answered up front (see ASSUME_YES)
+    :param question: String question
+    :return: Whether the answer is yes. Without a terminal to ask on, the answer is no.
+    """
+    if ASSUME_YES is not None:
+        log.info(f"{question} {'Yes' if ASSUME_YES else 'No'} (--{'yes' if ASSUME_YES else 'no'})")
+        return ASSUME_YES
+    if not (sys.stdin and sys.stdin.isatty()):
+        log.warning(f"{question} No - no terminal to ask on, pass --yes to continue instead")
+        return False
+    return input(f"\n{question} (Y/N): ").lower() in ["y", "yes"]
+
+
+async def run_blocking(func, *args):
+    """
+    Runs blocking work, such as file I/O and prompts, in a background thread,
+    so the bot keeps serving its connection to discord meanwhile.
+    The work sees the context variables of the calling task, such as current_channel.
+    :param func: Function to run
+    :param args: Arguments of the function
+    :return: The function's return value
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, func, *args))
+
+
 async def parse_slack_directory(file_path, force_all=False):
+    """
+    Locates the slack-root and .json logs of a path in a background thread, see locate_slack_directory()
+    """
+    return await run_blocking(locate_slack_directory, file_path, force_all)
+
+
+def locate_slack_directory(file_path, force_all=False):
     """
     Parses the path to find important root-files and relevant .json logs, and stores them in a dict of the form:\n
     {
         "root_files": {"file": path},\n
-        "history": {"channel": [path_json_logs]}
+        "history": {"channel": [path_json_logs]},\n
+        "sizes": {"channel": bytes_json_logs},\n
+        "root": path_root,\n
+        "state": path_directory_storing_journal_index_and_files
     }
+    The path may point into a .zip export (e.g. "export.zip/general"), whose files are then read straight from the archive.
     :param file_path: String path to directory or file
     :return: The resulting dict.
     """
     slack_dir = {}
     slack_dir["root_files"] = {}
     slack_dir["history"] = {}
+    slack_dir["sizes"] = {}
     
     slack_root_files = {
         "users.json" : "A file that maps internal user-ids to usernames, allowing message headers and mentions to display their human readable names",
@@ -90,134 +1967,133 @@ async def parse_slack_directory(file_path, force_all=False):
     root_files = dict(slack_root_files, **user_root_files)
 
     # Locate root
-    print(f"[INFO] Attempting to locate slack-root directory from path: {file_path}")
+    log.info(f"Attempting to locate slack-root directory from path: {file_path}")
     root = file_path
-    if os.path.isfile(file_path):
-        print("[WARNING] Path points at a file and not a directory")
-        print("[INFO] Assumes parent-directory is either root or a channel-subdir")
-        print("       | slack-root/  <- directory?")
-        print("       |__  *.json")
-        print("          | channel/  <- directory?")
-        print("          |    *.json")
+    if export_isfile(file_path):
+        log.warning("Path points at a file and not a directory")
+        log.info("Assumes parent-directory is either root or a channel-subdir\n       | slack-root/  <- directory?\n       |__  *.json\n          | channel/  <- directory?\n          |    *.json")
         root = os.path.dirname(file_path)
         
-    if any([os.path.exists(os.path.join(root, f)) for f in slack_root_files]):
-        print(f"[INFO] Success! slack-root found: {root}")
+    if any([export_isfile(os.path.join(root, f)) for f in slack_root_files]):
+        log.info(f"Success! slack-root found: {root}")
     else:
-        print(f"[WARNING] Directory is not root of a slack-log directory: {root}")
-        print("[INFO] Assumes directory is a channel-subdir, and parent-directory is the root.")
-        print("       | slack-root/  <- root?")
-        print("       |__  *.json")
-        print("          | channel/  <- directory")
-        print("          |    *.json")
+        log.warning(f"Directory is not root of a slack-log directory: {root}")
+        log.info("Assumes directory is a channel-subdir, and parent-directory is the root.\n       | slack-root/  <- root?\n       |__  *.json\n          | channel/  <- directory\n          |    *.json")
         root = os.path.dirname(root)
-        if any([os.path.exists(os.path.join(root, f)) for f in slack_root_files]):
-            print(f"[INFO] Success! slack-root found: {root}")
+        if any([export_isfile(os.path.join(root, f)) for f in slack_root_files]):
+            log.info(f"Success! slack-root found: {root}")
         else:
-            print("[WARNING] Parent-directory is not root of a slack-log directory; Unable to locate root")
-            query = input("\nDo you want to ignore and continue with input path forcefully treated as 'root'? (Y/N): ")
-            if query.lower() in ["y", "yes"]:
-                print(f"[INFO] Reverts to treating input path as root: {file_path}")
+            log.warning("Parent-directory is not root of a slack-log directory; Unable to locate root")
+            if confirm("Do you want to ignore and continue with input path forcefully treated as 'root'?"):
+                log.info(f"Reverts to treating input path as root: {file_path}")
                 root = file_path
             else:
-                print(f"[ERROR] User aborted - no root")
+                log.error(f"User aborted - no root")
                 return None
 
+    manifest = ExportManifest.open(root)
+
     # Assert existence of root-files, querying user to ignore errors
-    print("[INFO] Checking for slack-root files")
+    log.info("Checking for slack-root files")
     for f, descr in slack_root_files.items():
         f_path = os.path.join(root, f)
-        if os.path.exists(f_path):
-            print(f"[INFO] Successfully located file: {f}")
+        if manifest.has_file(f):
+            log.info(f"Successfully located file: {f}")
             slack_dir["root_files"][get_filename(f)] = f_path
         else:
-            print(f"[ERROR] Unable to locate slack-file: {f}")
-            print(f"        Description: {descr}")
-            query = input("\nDo you want to ignore and continue? (Y/N): ")
-            if query.lower() in ["y", "yes"]:
-                print(f"[OK] User ignored missing file.")
+            log.error(f"Unable to locate slack-file: {f}\n        Description: {descr}")
+            if confirm("Do you want to ignore and continue?"):
+                log.info(f"User ignored missing file.")
             else:
-                print(f"[ERROR] User aborted at missing file: {f}")
+                log.error(f"User aborted at missing file: {f}")
                 return None
     
-    print("[INFO] Checking for *user-created* slack-root files")
-    print("       Note: User is expected to manually create and fill these files if their functionality is desired.")
+    log.info("Checking for *user-created* slack-root files\n       Note: User is expected to manually create and fill these files if their functionality is desired.")
     for f, descr in user_root_files.items():
         f_path = os.path.join(root, f)
-        if os.path.exists(f_path):
-            print(f"[INFO] Successfully located user-created file: {f}")
+        if manifest.has_file(f):
+            log.info(f"Successfully located user-created file: {f}")
             slack_dir["root_files"][get_filename(f)] = f_path
         else:
-            print(f"[ERROR] Unable to locate user-created file: {f}")
-            print(f"        Description: {descr}")
-            query = input("\nDo you want to ignore and continue? (Y/N): ")
-            if query.lower() in ["y", "yes"]:
-                print(f"[INFO] User ignored missing file.")
+            log.error(f"Unable to locate user-created file: {f}\n        Description: {descr}")
+            if confirm("Do you want to ignore and continue?"):
+                log.info(f"User ignored missing file.")
             else:
-                print(f"[ERROR] User aborted at missing file: {f}")
+                log.error(f"User aborted at missing file: {f}")
                 return None
     
     # locate .json logs
-    print(f"[INFO] Attempting to locate relevant .json logs")
+    log.info(f"Attempting to locate relevant .json logs")
     if force_all is True:
-        subdirs = [d for d in [os.path.join(root, n) for n in os.listdir(root)] if os.path.isdir(d)]
-        for d in subdirs:
-            slack_dir["history"][get_basename(d)] = [os.path.join(d, f) for f in os.listdir(d) if f.endswith(".json")]
+        for d in manifest.channels():
+            slack_dir["history"][d] = manifest.logs(d)
+            slack_dir["sizes"][d] = manifest.size(d)
     else:
-        if os.path.isfile(file_path):
-            print(f"[WARNING] Path does not point at a directory.")
-            print(f"[INFO] Assumes path points at the exact .json log file user wants to export.")
+        if export_isfile(file_path):
+            log.warning(f"Path does not point at a directory.")
+            log.info(f"Assumes path points at the exact .json log file user wants to export.")
             if file_path.endswith(".json"):
-                slack_dir["history"][get_basename(os.path.dirname(file_path))] = file_path
+                slack_dir["history"][get_basename(os.path.dirname(file_path))] = [file_path]
+                slack_dir["sizes"][get_basename(os.path.dirname(file_path))] = export_stat(file_path)[0]
             else:
-                print(f"[ERROR] Path does not point at a .json file - skipping path.")
+                log.error(f"Path does not point at a .json file - skipping path.")
                 return None
         else:
-            subdirs = [file_path] + [d for d in [os.path.join(file_path, n) for n in os.listdir(file_path)] if os.path.isdir(d)]
+            # The path is either the root, including all of its directories, or one of them
+            if os.path.normpath(file_path) == manifest.root:
+                subdirs = [""] + manifest.channels()
+            else:
+                subdirs = [get_basename(file_path)]
             for d in subdirs:
-                slack_dir["history"][get_basename(d)] = [os.path.join(d, f) for f in os.listdir(d) if f.endswith(".json")]
+                slack_dir["history"][d or get_basename(root)] = manifest.logs(d)
+                slack_dir["sizes"][d or get_basename(root)] = manifest.size(d)
     
     slack_dir["root"] = root
+    # Files of the import can't be stored within a .zip export, so they are stored next to it instead
+    archive = split_archive_path(root)[0]
+    slack_dir["state"] = os.path.dirname(os.path.abspath(archive)) if archive else root
 
     if not slack_dir["history"]:
-        print(f"[ERROR] No history .json logs found at: {file_path}")
+        log.error(f"No history .json logs found at: {file_path}")
         return None
     else:
-        print(f"[INFO] Success! {len(slack_dir['history'])} .json logs loaded")
+        log.info(f"Success! {len(slack_dir['history'])} .json logs loaded")
         if not all([f in slack_dir["root_files"] for f in root_files]):
-            print(f"[WARNING] Missing important .json files: {({f: ('exists' if get_filename(f) in slack_dir['root_files'] else 'missing') for f in root_files})}")
+            log.warning(f"Missing important .json files: {({f: ('exists' if get_filename(f) in slack_dir['root_files'] else 'missing') for f in root_files})}")
 
     return slack_dir
 
 
-def get_display_names(slack_dir):
+def get_user_profiles(slack_dir):
     """
-    Generates a dictionary of user_id => display_name pairs
+    Generates the dictionaries of user_id => display_name and user_id => avatar_url pairs, in one pass over users.json
     :param slack_dir: Dict representing the slack-log directory
-    :return: Dictionary or None if no file is found
+    :return: Tuple of both dictionaries, or of None if no file is found
     """
     users = {}
+    avatars = {}
 
-    print(f"[INFO] Attempting to locate users.json")
+    log.info(f"Attempting to locate users.json")
 
     file_path = slack_dir["root_files"].get("users", None)
-    if (not file_path) or (not os.path.isfile(file_path)):
-        print(f"[ERROR] Unable to locate users.json: {file_path}")
-        return None
+    if (not file_path) or (not export_isfile(file_path)):
+        log.error(f"Unable to locate users.json: {file_path}")
+        return None, None
     try:
-        with open(file_path, encoding="utf-8") as f:
-            users_json = json.load(f)
-            for user in users_json:
-                users[user['id']] = (
-                    user['profile']['display_name'] if user['profile']['display_name'] else user['profile'][
-                        'real_name'])
-                print(f"\tUser ID: {user['id']} -> Display Name: {users[user['id']]}")
+        for user in iter_json_array(file_path):
+            users[user['id']] = (
+                user['profile']['display_name'] if user['profile']['display_name'] else user['profile'][
+                    'real_name'])
+            log.debug("User ID: %s -> Display Name: %s", user['id'], users[user['id']])
+            avatar_url = user['profile'].get('image_192') or user['profile'].get('image_72')
+            if avatar_url:
+                avatars[user['id']] = avatar_url
     except OSError as e:
-        print(f"[ERROR] Unable to load display names: {e}")
-        return None
+        log.error(f"Unable to load display names and avatars: {e}")
+        return None, None
     except json.JSONDecodeError as e:
-        print(f"[ERROR] Unable to load users.json.\n  JSONDecodeError: {e}")
-    return users
+        log.error(f"Unable to load users.json.\n  JSONDecodeError: {e}")
+    return users, avatars
 
 
 def get_slack2discord_user_mapping(slack_dir):
@@ -228,28 +2104,26 @@ def get_slack2discord_user_mapping(slack_dir):
     """
     slack2discord_users = {}
 
-    print(f"[INFO] Attempting to locate slack2discord_users.json")
+    log.info(f"Attempting to locate slack2discord_users.json")
     
     file_path = slack_dir["root_files"].get("slack2discord_users", None)
-    if (not file_path) or (not os.path.isfile(file_path)):
-        print(f"[ERROR] Unable to locate slack2discord_users.json: {file_path}")
+    if (not file_path) or (not export_isfile(file_path)):
+        log.error(f"Unable to locate slack2discord_users.json: {file_path}")
         return None
 
     try:
-        with open(file_path, encoding="utf-8") as f:
-            slack2discord_users_json = json.load(f)
-            for user in slack2discord_users_json:
-                slack_name = user["slack"]["name"]
-                discord_name = user["discord"]["name"]
-                if user["discord"]["id"]:
-                    discord_name = discord_name + f'#${user["discord"]["id"]}'
-                slack2discord_users[slack_name] = discord_name
-                print(f"\tslack2discord user mapping: {slack_name} -> {discord_name}")
+        for user in iter_json_array(file_path):
+            slack_name = user["slack"]["name"]
+            discord_name = user["discord"]["name"]
+            if user["discord"]["id"]:
+                discord_name = discord_name + f'#${user["discord"]["id"]}'
+            slack2discord_users[slack_name] = discord_name
+            log.debug("slack2discord user mapping: %s -> %s", slack_name, discord_name)
     except OSError as e:
-        print(f"[ERROR] Unable to load slack2discord user mapping: {e}")
+        log.error(f"Unable to load slack2discord user mapping: {e}")
         return None
     except json.JSONDecodeError as e:
-        print(f"[ERROR] Unable to load slack2discord_users.json.\n  JSONDecodeError: {e}")
+        log.error(f"Unable to load slack2discord_users.json.\n  JSONDecodeError: {e}")
     return slack2discord_users
 
 
@@ -261,104 +2135,432 @@ def get_channel_names(slack_dir):
     """
     channels = {}
 
-    print(f"[INFO] Attempting to locate channels.json")
+    log.info(f"Attempting to locate channels.json")
 
     file_path = slack_dir["root_files"].get("channels", None)
-    if (not file_path) or (not os.path.isfile(file_path)):
-        print(f"[ERROR] Unable to locate channels.json: {file_path}")
+    if (not file_path) or (not export_isfile(file_path)):
+        log.error(f"Unable to locate channels.json: {file_path}")
         return None
 
     try:
-        with open(file_path, encoding="utf-8") as f:
-            channels_json = json.load(f)
-            for channel in channels_json:
-                channels[channel['id']] = channel['name']
-                print(f"\tChannel ID: {channel['id']} -> Channel Name: {channels[channel['id']]}")
+        for channel in iter_json_array(file_path):
+            channels[channel['id']] = channel['name']
+            log.debug("Channel ID: %s -> Channel Name: %s", channel['id'], channels[channel['id']])
     except OSError as e:
-        print(f"[ERROR] Unable to load channel names: {e}")
+        log.error(f"Unable to load channel names: {e}")
         return None
     except json.JSONDecodeError as e:
-        print(f"[ERROR] Unable to load channels.json.\n  JSONDecodeError: {e}")
+        log.error(f"Unable to load channels.json.\n  JSONDecodeError: {e}")
     return channels
 
-async def fill_references(ctx, message, users, slack2discord_users, channels):
+
+def hash_export_file(path):
+    """
+    :param path: String path to a file, which may be within a .zip export
+    :return: Hex sha256 digest of the file's contents
+    :raises OSError: If the file can not be read
+    """
+    digest = hashlib.sha256()
+    with open_export_file(path, binary=True) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LookupTables:
+    """
+    The uid => display name, uid => avatar url, cid => channel name and slack => discord user mapping tables,
+    compiled once from the root files into a marshal file in the slack-root, and loaded from there by later imports.
+    The tables are keyed by the size, mtime and sha256 of each root file: a file with a different size is compiled
+    again, while one with only a different mtime (e.g. extracted again) is hashed, and only compiled again if changed.
+    """
+    # Tables already loaded by this process, by path
+    cache = {}
+    # Bumped whenever the compiled tables change
+    VERSION = 1
+    SOURCES = ("users", "channels", "slack2discord_users")
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {} # root file => [path, size, mtime, sha256], or None if missing
+        self.tables = {}
+
+    @classmethod
+    def open(cls, slack_dir):
+        """
+        Loads the lookup tables of an export, compiling and saving them if any of its root files changed
+        :param slack_dir: Dict representing the slack-log directory
+        :return: LookupTables
+        """
+        path = os.path.join(slack_dir["state"], LOOKUP_TABLES_NAME)
+        tables = cls.cache.get(path)
+        if tables is None:
+            tables = cls.cache[path] = cls(path)
+            try:
+                with open(path, "rb") as f:
+                    data = marshal.load(f)
+                if data["version"] == cls.VERSION:
+                    tables.sources, tables.tables = data["sources"], data["tables"]
+            except (OSError, EOFError, ValueError, TypeError, KeyError):
+                pass
+        changed = tables.check(slack_dir)
+        if changed is None:
+            log.info(f"Loaded lookup tables: {path}")
+            return tables
+        log.info(f"Compiling lookup tables: {path}")
+        users, avatars = get_user_profiles(slack_dir)
+        tables.tables = {
+            "users": users,
+            "avatars": avatars,
+            "slack2discord_users": get_slack2discord_user_mapping(slack_dir),
+            "channels": get_channel_names(slack_dir),
+        }
+        tables.sources = changed
+        tables.save()
+        return tables
+
+    def check(self, slack_dir):
+        """
+        :param slack_dir: Dict representing the slack-log directory
+        :return: None if the tables are up to date, else the sources to compile them from
+        """
+        sources, changed = {}, not self.tables
+        for name in self.SOURCES:
+            file_path = slack_dir["root_files"].get(name)
+            if not file_path or not export_isfile(file_path):
+                sources[name] = None
+                changed |= self.sources.get(name) is not None
+                continue
+            try:
+                size, mtime = export_stat(file_path)
+                known = self.sources.get(name)
+                if known and known[:3] == [file_path, size, mtime]:
+                    sources[name] = known
+                    continue
+                sources[name] = [file_path, size, mtime, hash_export_file(file_path)]
+            except OSError as e:
+                log.warning(f"Unable to check {name}.json: {e}")
+                sources[name], changed = None, True
+                continue
+            if not known or known[0] != file_path or known[1] != size or known[3] != sources[name][3]:
+                changed = True
+        if changed:
+            return sources
+        if sources != self.sources:
+            # Only the mtimes changed, so there is no need to compile again
+            self.sources = sources
+            self.save()
+        return None
+
+    def save(self):
+        try:
+            with open(self.path, "wb") as f:
+                marshal.dump({"version": self.VERSION, "sources": self.sources, "tables": self.tables}, f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Unable to save lookup tables: {e}")
+
+REFERENCE_PATTERN = re.compile(r"<([@#])([A-Z0-9]+)>")
+MENTION_PATTERN = re.compile(r"<@([A-Z0-9]+)>")
+# Characters of the longest <@user id> token, kept between the chunks of a log scanned for mentions
+MAX_MENTION_LENGTH = 64
+
+
+def scan_mentions(f):
+    """
+    :param f: Text file object
+    :return: Set of the user ids @mentioned in the file, read JSON_READ_SIZE characters at a time
+    """
+    mentions = set()
+    tail = ""
+    while True:
+        chunk = f.read(JSON_READ_SIZE)
+        if not chunk:
+            return mentions
+        buf = tail + chunk
+        mentions.update(MENTION_PATTERN.findall(buf))
+        # A mention cut off by the end of this chunk is completed by the next
+        tail = buf[-MAX_MENTION_LENGTH:]
+
+
+def find_mentions(slack_dir):
+    """
+    Finds the users @mentioned in the .json logs of a slack-log directory, by scanning their text rather than parsing them.
+    The mentions of each log are saved in the slack-root, and a log is only scanned again once its size or mtime changed.
+    :param slack_dir: Dict representing the slack-log directory
+    :return: Set of user ids
+    """
+    path = os.path.join(slack_dir["state"], MENTIONS_NAME)
+    try:
+        with open(path, encoding="utf-8") as f:
+            cache = json.load(f) # path of a .json log -> [size, mtime, [user ids]]
+    except (OSError, ValueError):
+        cache = {}
+    mentions, changed = set(), False
+    for json_file in (f for fs in slack_dir["history"].values() for f in fs):
+        try:
+            size, mtime = export_stat(json_file)
+            if cache.get(json_file, [None, None])[:2] != [size, mtime]:
+                with open_export_file(json_file) as f:
+                    cache[json_file] = [size, mtime, sorted(scan_mentions(f))]
+                changed = True
+        except OSError as e:
+            log.error(f"Unable to scan for mentions: {e}")
+            continue
+        mentions.update(cache[json_file][2])
+    if changed:
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+        except OSError as e:
+            log.warning(f"Unable to save mentions: {e}")
+    return mentions
+
+
+# Discord members looked up by name, kept for the rest of the run: (guild id, name) -> member, or None if not found
+resolved_members = {}
+# Member queries sent to discord at once, see resolve_members()
+MAX_CONCURRENT_MEMBER_QUERIES = 8
+# Members a query returns at most (discord's maximum). A full result may leave out the exact match, see resolve_members()
+MEMBER_QUERY_LIMIT = 100
+
+
+async def resolve_members(guild, names):
+    """
+    Looks up the members of a guild by name, with targeted queries, MAX_CONCURRENT_MEMBER_QUERIES at a time,
+    rather than chunking every member at startup. Queries match the start of names, so when one returns
+    MEMBER_QUERY_LIMIT members without the exact name, every member is chunked once after all.
+    Results are kept in resolved_members for build_reference_table().
+    :param guild: Guild to look the members up in
+    :param names: Iterable of discord names, optionally with their #discriminator
+    """
+    names = [name for name in dict.fromkeys(names) if name and (guild.id, name) not in resolved_members]
+    if not names:
+        return
+    log.info(f"Looking up {len(names)} mentioned members on discord")
+    cached = index_members(guild.members)
+    can_query = hasattr(guild, "query_members") and not getattr(guild, "chunked", False)
+    queries = asyncio.Semaphore(MAX_CONCURRENT_MEMBER_QUERIES)
+    chunk_lock = asyncio.Lock()
+    everyone = None
+
+    async def chunk():
+        nonlocal everyone
+        async with chunk_lock:
+            if everyone is None:
+                log.info(f"Member lookups were cut off - fetching every member of the server")
+                try:
+                    everyone = index_members(await guild.chunk())
+                except (discord.ClientException, asyncio.TimeoutError) as e:
+                    log.warning(f"Unable to fetch members\n        {type(e).__name__}: {e}")
+                    everyone = {}
+        return everyone
+
+    async def resolve(name):
+        member = cached.get(name)
+        if member is None and can_query:
+            found = []
+            async with queries:
+                try:
+                    # Queries match the start of the username or nickname
+                    found = await guild.query_members(query=name.split("#")[0], limit=MEMBER_QUERY_LIMIT)
+                except (discord.ClientException, asyncio.TimeoutError) as e:
+                    log.warning(f"Unable to look up member: {name}\n        {type(e).__name__}: {e}",
+                                extra=summary("Unable to look up member"))
+            member = index_members(found).get(name)
+            if member is None and len(found) >= MEMBER_QUERY_LIMIT:
+                member = (await chunk()).get(name)
+        resolved_members[(guild.id, name)] = member
+
+    await asyncio.gather(*(resolve(name) for name in names))
+
+
+def mentioned_names(users, slack2discord_users, mentioned):
+    """
+    :param users: Dictionary of user_id => display_name pairs
+    :param slack2discord_users: Dictionary of slack_user => discord_user pairs
+    :param mentioned: Set of the user ids that are mentioned
+    :return: List of the discord names the mentioned users are looked up by, see build_reference_table()
+    """
+    names = []
+    for uid in mentioned:
+        slack_name = (users or {}).get(uid)
+        if slack_name:
+            names.append((slack2discord_users or {}).get(slack_name, slack_name))
+    return names
+
+
+def index_members(members):
     """
-    Fills in @mentions and #channels with their known display names
-    :param message: Raw message to be filled with usernames and channel names instead of IDs
+    Indexes members by the names guild.get_member_named() matches, which scans every member on each call
+    :param members: Iterable of discord members
+    :return: Dictionary of name => member, with name#discriminator taking precedence over names and nicknames
+    """
+    members = list(members)
+    index = {}
+    for member in members:
+        index.setdefault(f"{member.name}#{member.discriminator}", member)
+    for member in members:
+        for name in (member.nick, member.name):
+            if name:
+                index.setdefault(name, member)
+    return index
+
+
+def build_reference_table(ctx, users, slack2discord_users, channels, mentioned=None):
+    """
+    Resolves every known @mention and #channel reference once, up front
+    :param ctx: Context whose guild the references are resolved against
     :param users: Dictionary of user_id => display_name pairs
+    :param slack2discord_users: Dictionary of slack_user => discord_user pairs
     :param channels: Dictionary of channel_id => channel_name pairs
-    :return: Filled message string
+    :param mentioned: Set of the user ids that are mentioned, resolving only those, or None to resolve every user
+    :return: Dictionary of the form {"@": {user_id: mention}, "#": {channel_id: mention},
+             "warnings": {(kind, id): [(level, message, summary)]}}
     """
+    # Warnings for unresolved references are deferred until the reference is actually used
+    references = {"@": {}, "#": {}, "warnings": {}}
     if users:
+        # Members looked up by resolve_members() are used as is, and only others are looked up in the guild's cache
+        resolved = {name: member for (guild_id, name), member in resolved_members.items() if guild_id == ctx.guild.id}
+        members = None
+
+        def find_member(name):
+            nonlocal members
+            if name in resolved:
+                return resolved[name]
+            if members is None:
+                members = index_members(ctx.guild.members)
+            return members.get(name)
+
         for uid, slack_name in users.items():
-            old_str = f"<@{uid}>"
-            if old_str in message and slack_name:
-                new_str = f"@{slack_name}"
-                if slack2discord_users and slack_name in slack2discord_users:
-                    discord_name = slack2discord_users[slack_name]
-                    discord_user = ctx.guild.get_member_named(discord_name)
-                    if discord_user:
-                        new_str = f"{discord_user.mention}"
-                    else:
-                        print(f"[ERROR] Mapped user not found on discord: [{slack_name}: {discord_name}]")
-                        print(f"        @mentions of user will not be translated to discord-equivalent")
+            if not slack_name or (mentioned is not None and uid not in mentioned):
+                continue
+            new_str = f"@{slack_name}"
+            if slack2discord_users and slack_name in slack2discord_users:
+                discord_name = slack2discord_users[slack_name]
+                warnings = []
+                discord_user = find_member(discord_name)
+                if discord_user:
+                    new_str = f"{discord_user.mention}"
                 else:
-                    print(f"[WARNING] User not mapped: {slack_name}")
-                    print(f"[FIX] Attempt to match the slack name instead")
-                    discord_user = ctx.guild.get_member_named(slack_name)
-                    if discord_user:
-                        new_str = f"{discord_user.mention}"
-                    else:
-                        print(f"[ERROR] User not found on discord: {slack_name}")
-                        print(f"        @mentions of user will contain their ID instead of display name")
-                
-                message = message.replace(old_str, new_str)
+                    warnings += [(logging.ERROR, f"Mapped user not found on discord: [{slack_name}: {discord_name}]\n"
+                                  f"        @mentions of user will not be translated to discord-equivalent",
+                                  "Mapped user not found on discord")]
+            else:
+                warnings = [(logging.WARNING, f"User not mapped: {slack_name} - attempting to match the slack name instead",
+                             "User not mapped")]
+                discord_user = find_member(slack_name)
+                if discord_user:
+                    new_str = f"{discord_user.mention}"
+                else:
+                    warnings += [(logging.ERROR, f"User not found on discord: {slack_name}\n"
+                                  f"        @mentions of user will contain their ID instead of display name",
+                                  "User not found on discord")]
+            if warnings:
+                references["warnings"][("@", uid)] = warnings
+            references["@"][uid] = new_str
     if channels:
+        discord_channels = {}
+        for c in ctx.guild.channels:
+            discord_channels.setdefault(c.name, c)
         for cid, name in channels.items():
-            old_str = f"<#{cid}>"
-            if old_str in message:
-                new_str = f"#{name}"
-                channel = discord.utils.get(ctx.guild.channels, name=name)
-                if channel:
-                    new_str = f"{channel.mention}"
-                else:
-                    print(f"[ERROR] Channel not found on discord: {name}")
-                    print(f"        #channel references of channel will not be translated to discord-equivalent")
+            new_str = f"#{name}"
+            channel = discord_channels.get(name)
+            if channel:
+                new_str = f"{channel.mention}"
+            else:
+                references["warnings"][("#", cid)] = [
+                    (logging.ERROR, f"Channel not found on discord: {name}\n"
+                     f"        #channel references of channel will not be translated to discord-equivalent",
+                     "Channel not found on discord")]
+            references["#"][cid] = new_str
+    return references
+
 
-                message = message.replace(old_str, new_str)
-    return message
+def fill_references(message, references, used=None):
+    """
+    Fills in @mentions and #channels with their known display names, in a single scan of the message
+    :param message: Raw message to be filled with usernames and channel names instead of IDs
+    :param references: Table of resolved references, as built by build_reference_table()
+    :param used: Set collecting the (kind, id) of the unresolved references used, leaving their warnings to be
+                 logged by warn_references(), rather than logging them right away
+    :return: Filled message string
+    """
+    def replace(match):
+        kind, ref_id = match.groups()
+        if (kind, ref_id) in references["warnings"]:
+            if used is None:
+                warn_references(references, [(kind, ref_id)])
+            else:
+                used.add((kind, ref_id))
+        return references[kind].get(ref_id, match.group(0))
+    return REFERENCE_PATTERN.sub(replace, message)
+
+
+def warn_references(references, used):
+    """
+    Logs the deferred warnings of unresolved references, once per reference
+    :param references: Table of resolved references, as built by build_reference_table()
+    :param used: Iterable of the (kind, id) of the references used
+    """
+    for key in used:
+        # Plans are filled in background threads, which may race for the same reference's warnings
+        for level, warning, warning_kind in references["warnings"].pop(key, ()):
+            log.log(level, warning, extra=summary(warning_kind))
 
 
 def parse_important_files(slack_dir):
-    users = get_display_names(slack_dir)
+    tables = LookupTables.open(slack_dir).tables
+    users = tables["users"]
     if users:
-        print(f"[INFO] users.json found - attempting to fill @mentions")
+        log.info(f"users.json found - attempting to fill @mentions")
     else:
-        print(f"[WARNING] No users.json found - @mentions will contain user IDs instead of display names")
+        log.warning(f"No users.json found - @mentions will contain user IDs instead of display names")
 
-    slack2discord_users = get_slack2discord_user_mapping(slack_dir)
+    slack2discord_users = tables["slack2discord_users"]
     if slack2discord_users:
-        print(f"[INFO] slack2discord_users.json found - attempting to map @mentions")
+        log.info(f"slack2discord_users.json found - attempting to map @mentions")
     else:
-        print(f"[ERROR] No slack2discord_users.json found.")
-        print(f"[FIX] Querying user for known mappings to generate file") # TODO
-        print(f"[ERROR] Querying feature not implemented - @mentions will not map")
+        log.error(f"No slack2discord_users.json found.\n"
+                  f"        Querying user for known mappings to generate file is not implemented - @mentions will not map") # TODO
 
-    channels = get_channel_names(slack_dir)
+    channels = tables["channels"]
     if channels:
-        print(f"[INFO] channels.json found - attempting to fill #channel references")
+        log.info(f"channels.json found - attempting to fill #channel references")
     else:
-        print(f"[WARNING] No channels.json found - #channel references will contain their IDs instead of names")
+        log.warning(f"No channels.json found - #channel references will contain their IDs instead of names")
     
     return users, slack2discord_users, channels
 
 
+# guild id -> asyncio.Lock, so concurrent imports never create the same channel twice
+channel_locks = {}
+# (guild id, name) -> channel created by the bot, until discord reports it back into the guild's channels
+created_channels = {}
+
+
 async def get_or_create_channel(ctx, name):
-    channel = discord.utils.get(ctx.guild.channels, name=name, type=discord.ChannelType.text)
-    if not channel:
-        print(f"[INFO] Could not find channel: {name}")
-        print(f"       Creating channel")
-        channel = await ctx.guild.create_text_channel(name, reason="Migrating Slack channel")
+    # Channels are always created by the main bot, whichever bot imports them
+    async with channel_locks.setdefault(ctx.guild.id, asyncio.Lock()):
+        channel = discord.utils.get(ctx.guild.channels, name=name, type=discord.ChannelType.text) \
+            or created_channels.get((ctx.guild.id, name))
+        if not channel:
+            log.info(f"Could not find channel: {name}\n       Creating channel")
+            attempts = 0
+
+            async def create():
+                nonlocal attempts
+                attempts += 1
+                if attempts > 1:
+                    # An attempt whose response was lost may have created the channel
+                    existing = discord.utils.get(await ctx.guild.fetch_channels(), name=name, type=discord.ChannelType.text)
+                    if existing:
+                        return existing
+                return await ctx.guild.create_text_channel(name, reason="Migrating Slack channel")
+
+            route = RateLimitScheduler.route_key("POST", f"/guilds/{ctx.guild.id}/channels")
+            channel = await scheduler.request(route, create)
+            created_channels[(ctx.guild.id, name)] = channel
     return channel
 
 
@@ -366,7 +2568,7 @@ def parse_timestamp(message):
     if 'ts' in message:
         return datetime.fromtimestamp(float(message['ts'])).strftime('%d/%m/%Y at %H:%M:%S')
     else:
-        print(f"[WARNING] No timestamp in message")
+        log.warning(f"No timestamp in message", extra=summary("No timestamp in message"))
     return '<no timestamp>'
 
 
@@ -379,27 +2581,81 @@ def parse_user(message, users):
         if present_keys:
             username = user[present_keys[0]]
         else:
-            print(f"[ERROR] Unable to parse user: {user}")
+            log.error(f"Unable to parse user: {user}", extra=summary("Unable to parse user"))
     else:
-        print(f"[WARNING] No 'user_profile' field in message")
-        print(f"[FIX] Attempting 'user' field for uid")
+        log.debug("No 'user_profile' field in message - attempting 'user' field for uid")
         if "user" in message:
-            print(f"[INFO] Located 'user' field, attempting to map uid to username")
             username = message['user']
             if users and username in users:
                 username = users[username]
             else:
-                print(f"[WARNING] Failed to map uid to slack username - name will remain the unmapped uid: {username}")
+                log.warning(f"Failed to map uid to slack username - name will remain the unmapped uid: {username}",
+                            extra=summary("Failed to map uid to slack username"))
         else:
-            print(f"[ERROR] No 'user' field in message - defaulting to '<unknown user>'")
+            log.error(f"No 'user' field in message - defaulting to '<unknown user>'", extra=summary("No 'user' field in message"))
     return username
 
 
+def parse_avatar(message, avatars):
+    user = message.get('user_profile')
+    if user:
+        for k in ['image_192', 'image_72']:
+            if user.get(k):
+                return user[k]
+    if avatars and message.get('user') in avatars:
+        return avatars[message['user']]
+    return None
+
+
+SLACK_MARKUP_PATTERN = re.compile(r"<([@#!]?)([^>|]+)(?:\|([^>]+))?>")
+
+
+def parse_thread_name(message, username, users):
+    """
+    Names a thread after the first line of the message owning it
+    :param message: Dict of the slack message
+    :param username: Name of the message's author
+    :param users: Dictionary of user_id => display_name pairs
+    :return: Name of at most MAX_THREAD_NAME_CHARACTERS characters
+    """
+    def replace(match):
+        kind, ref_id, label = match.groups()
+        if label:
+            return f"{kind}{label}" if kind in "@#" else label
+        if kind == "@":
+            return f"@{users.get(ref_id, ref_id) if users else ref_id}"
+        return f"{kind}{ref_id}" if kind == "#" else ref_id
+
+    lines = [l for l in (message.get("text") or "").splitlines() if l.strip()]
+    name = " ".join(SLACK_MARKUP_PATTERN.sub(replace, lines[0]).split()) if lines else ""
+    if not name:
+        name = f"{username} - {parse_timestamp(message)}"
+    if len(name) > MAX_THREAD_NAME_CHARACTERS:
+        name = name[:MAX_THREAD_NAME_CHARACTERS - 3].rstrip() + "..."
+    return name
+
+
+def format_header(username, timestamp):
+    return f"**{username}** *({timestamp})*"
+
+
+def webhook_username(username):
+    """
+    :param username: Name to post a webhook message under
+    :return: The name within MAX_USERNAME_CHARACTERS, with the words discord rejects in usernames (see
+             FORBIDDEN_USERNAME_WORDS) spelled with look-alike letters, and a placeholder if left empty
+    """
+    username = FORBIDDEN_USERNAME_WORDS.sub(lambda m: m.group(0).translate(FORBIDDEN_USERNAME_LETTERS), username)
+    return username.strip()[:MAX_USERNAME_CHARACTERS] or "<unknown user>"
+
+
 def parse_text(message, username):
     text = message.get('text')
     if text:
+        if USE_WEBHOOKS:
+            return text # The webhook posts as the user, so no header is needed
         timestamp = parse_timestamp(message)
-        return f"**{username}** *({timestamp})*\n{text}"
+        return f"{format_header(username, timestamp)}\n{text}"
     return None
 
 
@@ -416,28 +2672,36 @@ def parse_files(message):
                 "timestamp": datetime.fromtimestamp(file["timestamp"]),
             }
             files.append({k:v for k,v in file.items() if v is not None})
-            print(f"[INFO] Attached file: {file['title']}")
+            log.debug("Attached file: %s", file['title'])
         else:
-            print(f"[ERROR] File has no 'url_private' field - Unable to migrate file: {file}")
+            log.error(f"File has no 'url_private' field - Unable to migrate file: {file}", extra=summary("File has no 'url_private' field"))
     files = [discord.Embed(**f) for f in files]
     files = [e.set_image(url=e.url) for e in files]
     
     if not "user" in message:
-        print(f"[DEBUG] files can exist without a 'user' field!!!")
+        log.debug("files can exist without a 'user' field!!!")
     
     return files
 
 
-def parse_message(message, users):
+def parse_message(message, users, avatars=None):
+    """
+    Parses a slack message into the parts needed to send it
+    :param message: Dict of the slack message
+    :param users: Dictionary of user_id => display_name pairs
+    :param avatars: Dictionary of user_id => avatar_url pairs, used when posting through webhooks
+    :return: Dict of the form {"id", "ts", "user", "msg", "text", "files", "attachments", "thread", "thread_name", "author"},
+             or None if it should not be imported
+    """
     msg = None
     files = None
 
     if message.get("subtype", None) == "channel_join":
-        print(f"[INFO] Message is a 'channel_join' message")
+        log.debug("Message is a 'channel_join' message")
         return None
 
     if message.get("subtype", None) == "bot_message":
-        print(f"[INFO] Message is a 'bot_message' message")
+        log.debug("Message is a 'bot_message' message")
         return None
     
     msg_id = message.get("client_msg_id", None)
@@ -449,162 +2713,1121 @@ def parse_message(message, users):
     if "files" in message:
         files = parse_files(message)
 
+    timestamp = parse_timestamp(message)
+
     # Create message-header for pure attachments
-    if files and not msg:
-        timestamp = parse_timestamp(message)
-        
-        msg = f"**{username}** *({timestamp})* - *Attachments:*"
+    if files and not msg and not USE_WEBHOOKS:
+        msg = f"{format_header(username, timestamp)} - *Attachments:*"
     
     if not msg and not files:
-        print(f"[ERROR] Failed to parse message: {message}")
+        log.error(f"Failed to parse message: {message}", extra=summary("Failed to parse message"))
         return None
 
     thread = message.get("thread_ts", None)
+    thread_name = parse_thread_name(message, username, users) if thread else None
+    author = {"username": username, "avatar_url": parse_avatar(message, avatars), "timestamp": timestamp}
+
+    return {"id": msg_id, "ts": message.get("ts"), "user": message.get("user"), "msg": msg, "text": message.get("text"),
+            "files": files, "attachments": [f for f in message.get("files", []) if "url_private" in f],
+            "thread": thread, "thread_name": thread_name, "author": author}
+
+
+def parse_messages(messages, users, avatars=None):
+    """
+    Parses slack messages, leaving out those that are not to be imported
+    :param messages: Iterable of slack message dicts
+    :param users: Dictionary of user_id => display_name pairs
+    :param avatars: Dictionary of user_id => avatar_url pairs
+    :return: Generator of parsed messages, see parse_message()
+    """
+    for message in messages:
+        log.debug("Parsing message:")
+        parsed = parse_message(message, users, avatars)
+        if not parsed:
+            log.debug("Ignored unparsed message.")
+        else:
+            yield parsed
+
+
+# Users, avatars and references of the import a parse process works for, see init_parse_worker()
+parse_context = {}
+
+
+def init_parse_worker(context, log_queue, level):
+    """
+    Initializes a process of a ParsePool
+    :param context: Dict of the "users", "avatars" and "references" messages are parsed with
+    :param log_queue: Queue forwarding logged records to the importing process
+    :param level: Level of the importing process' logger
+    """
+    parse_context.update(context)
+    log.handlers = [logging.handlers.QueueHandler(log_queue)]
+    log.setLevel(level)
+    log.propagate = False
+
+
+def skip_records(records, skip):
+    """
+    :param records: List of parsed messages, see parse_message()
+    :param skip: Function of a parsed message, returning whether it was already imported, which may read the journal
+    :return: List of the records that are not skipped
+    """
+    kept = []
+    for record in records:
+        if record["ts"] and skip(record):
+            log.debug("Message already imported - skipping")
+        else:
+            kept.append(record)
+    return kept
+
+
+def prepare_messages(source, context=None):
+    """
+    Parses slack messages into records ready to be sent, with their references filled in
+    :param source: List of messages, as dicts or json strings
+    :param context: Dict of the "users", "avatars" and "references" to parse with, defaulting to the parse_context.
+                    References are not filled in if None.
+    :return: Tuple of the list of parsed messages (see parse_message()), and the set of unresolved references
+             they use, whose warnings are logged by the importing process (see warn_references())
+    """
+    context = context or parse_context
+    messages = (json.loads(message) if isinstance(message, str) else message for message in source)
+    records = list(parse_messages(messages, context["users"], context["avatars"]))
+    used = set()
+    if context["references"] is None:
+        return records, used # left to be filled in when replaying a plan, see compile_plan()
+    for record in records:
+        record["msg"] = fill_references(record["msg"] or "", context["references"], used)
+        if record["text"]:
+            record["text"] = fill_references(record["text"], context["references"], used)
+    return records, used
+
+
+async def coalesce_messages(records, window):
+    """
+    Merges consecutive messages by the same user in the same channel or thread, sent within `window` seconds
+    of the previous one, into a single message within MAX_CHARACTERS and MAX_EMBEDS.
+    Each merged line is prefixed with the time it was sent.
+    Messages owning a thread are never merged, so the thread keeps its own parent message.
+    :param records: Async iterable of parsed messages, see parse_message()
+    :param window: Maximum seconds between merged messages
+    :return: Async generator of parsed messages, listing the ts of any messages merged into them under "coalesced"
+    """
+    def owns_thread(record):
+        return record["thread"] and record["thread"] == record["ts"]
+
+    pending = None
+    last_ts = None
+    async for record in records:
+        if pending and record["user"] and record["user"] == pending["user"] and record["thread"] == pending["thread"] \
+                and not owns_thread(pending) and not owns_thread(record) \
+                and record["ts"] and last_ts is not None and float(record["ts"]) - last_ts <= window:
+            line = None
+            if record["text"]:
+                line = f"*({datetime.fromtimestamp(float(record['ts'])).strftime('%H:%M:%S')})* {record['text']}"
+            msg = "\n".join(filter(None, [pending["msg"], line]))
+            files = (pending["files"] or []) + (record["files"] or [])
+            if len(msg) <= MAX_CHARACTERS and len(files) <= MAX_EMBEDS:
+                pending["msg"] = msg
+                pending["files"] = files
+                pending["attachments"] = pending["attachments"] + record["attachments"]
+                pending["coalesced"].append(record["ts"])
+                last_ts = float(record["ts"])
+                continue
+        if pending:
+            yield pending
+        pending = dict(record, coalesced=[])
+        last_ts = float(record["ts"]) if record["ts"] else None
+    if pending:
+        yield pending
+
+
+def _split_message(msg, limit, prefix, fences, max_chunks=None):
+    chunks = []
+    start = 0
+    opener = None # code fence re-opened at the start of the current chunk, e.g. "```py"
+    closer = "\n" + CODE_FENCE
+    while True:
+        head = (prefix if chunks else "") + (opener + "\n" if opener else "")
+        room = limit - len(head)
+        if len(msg) - start <= room:
+            chunks.append(head + msg[start:])
+            return chunks
+        # Leave room to close a code block the cut may fall within
+        end = start + room - len(closer)
+        cut, skip = end, 0
+        if max_chunks:
+            # Break at the last newline, or else whitespace, dropping the character broken at.
+            #  Breaking early may only leave as much behind as the remaining chunks are sure to fit,
+            #  assuming each of them re-opens a code block.
+            capacity = limit - len(prefix) - len(closer) - (len(CODE_FENCE) + MAX_FENCE_LANGUAGE + 1 if fences else 0)
+            lo = max(start, len(msg) - (max_chunks - len(chunks) - 1) * capacity - 1)
+            brk = msg.rfind("\n", lo, end)
+            if brk <= start:
+                brk = max(msg.rfind(" ", lo, end), msg.rfind("\t", lo, end))
+            if brk > start:
+                cut, skip = brk, 1
+        k = bisect.bisect_left(fences, cut)
+        if k and fences[k-1] + len(CODE_FENCE) > cut and fences[k-1] > start:
+            # Don't cut through a fence itself
+            k -= 1
+            cut, skip = fences[k], 0
+        chunk = msg[start:cut]
+        opener = None
+        if k % 2: # cut within a code block, which is closed here and re-opened in the next chunk
+            line_end = msg.find("\n", fences[k-1], cut)
+            lang = msg[fences[k-1] + len(CODE_FENCE):line_end] if line_end != -1 else ""
+            opener = CODE_FENCE + (lang if lang.isidentifier() and len(lang) <= MAX_FENCE_LANGUAGE else "")
+            chunk += closer
+        chunks.append(head + chunk)
+        start = cut + skip
+
+
+def split_message(msg, limit=MAX_CHARACTERS, prefix=CONTINUATION_PREFIX):
+    """
+    Splits a message exceeding the character limit into chunks, computing all boundaries in one pass over it.
+    Chunks break at the last newline or whitespace that fits, as long as that doesn't take more messages than
+    cutting exactly at the limit would. Code blocks cut by a split are closed, and re-opened in the next chunk.
+    :param msg: Message text
+    :param limit: Maximum characters of each chunk, including its prefix and any re-opened code fence
+    :param prefix: Prefix of every chunk after the first
+    :return: List of chunks
+    """
+    if len(msg) <= limit:
+        return [msg]
+    fences = [m.start() for m in re.finditer(re.escape(CODE_FENCE), msg)]
+    hard = _split_message(msg, limit, prefix, fences)
+    chunks = _split_message(msg, limit, prefix, fences, max_chunks=len(hard))
+    return chunks if len(chunks) <= len(hard) else hard
+
+
+def message_nonce(channel, ts, part=0):
+    """
+    :param channel: Channel or thread the message is sent to
+    :param ts: Slack timestamp of the message
+    :param part: Index of the message, of those the slack message was split into
+    :return: Nonce of the message, the same every time the message is sent
+    """
+    return hashlib.sha256(f"{channel.id}/{ts}/{part}".encode()).hexdigest()[:25] # discord allows up to 25 characters
 
-    return msg_id, msg, files, thread
+
+async def send_with_nonce(channel, content=None, nonce=None, reference=None, **kwargs):
+    """
+    Sends a message with a nonce that discord enforces: sending a message with the nonce of a message it created
+    within the last minutes returns that message, instead of creating a duplicate.
+    discord.py does not expose enforcing the nonce, so the message is sent through its HTTP client.
+    :param channel: Channel or thread to send to
+    :param content: Text of the message
+    :param nonce: Nonce of the message, see message_nonce()
+    :param reference: Message to reference (reply to)
+    :param kwargs: Embeds, files and allowed mentions of the message, as passed to channel.send()
+    :return: The message sent
+    """
+    state = getattr(channel, "_state", None)
+    if nonce is None or state is None or discord.__version__[0] < "2":
+        return await channel.send(content, reference=reference, nonce=nonce, **kwargs)
+    reference = reference.to_message_reference_dict() if reference else discord.utils.MISSING
+    with discord.http.handle_message_parameters(content=content, nonce=nonce, message_reference=reference,
+                                                previous_allowed_mentions=state.allowed_mentions, **kwargs) as params:
+        if params.payload is not None:
+            params.payload["enforce_nonce"] = True
+        else:
+            params.multipart[0]["value"] = json.dumps(dict(json.loads(params.multipart[0]["value"]), enforce_nonce=True))
+        data = await state.http.send_message(channel.id, params=params)
+    return state.create_message(channel=channel, data=data)
 
 
-async def send_message(ctx, msg, ref=None, embeds=None, allowed_mentions=None):
-    if not msg:
-        print(f"[DEBUG] Why are you here? - Skipping empty message")
+def batch_files(paths, limit=None):
+    """
+    Groups files into the batches uploaded with one message, within MAX_FILES and the upload size limit
+    :param paths: List of paths to files
+    :param limit: Total size in bytes the files of one message may take up, or None for no limit
+    :return: List of lists of paths
+    """
+    batches = []
+    size = 0
+    for path in paths:
+        file_size = os.path.getsize(path)
+        if not batches or len(batches[-1]) >= MAX_FILES or (limit is not None and size + file_size > limit):
+            batches.append([])
+            size = 0
+        batches[-1].append(path)
+        size += file_size
+    return batches
+
+
+async def send_message(ctx, msg, ref=None, embeds=None, allowed_mentions=None, author=None, files=None, ts=None,
+                       files_limit=None):
+    """
+    Sends a message to a channel or thread, splitting it into several if it exceeds discord's limits
+    :param ctx: Context, channel or thread to send to
+    :param msg: Message text
+    :param ref: Message to reference (reply to) with the first message sent
+    :param embeds: List of embeds to attach
+    :param allowed_mentions: AllowedMentions of the messages
+    :param author: Dict of the slack author's "username", "avatar_url" and "timestamp",
+                   used to post as them through a webhook if USE_WEBHOOKS is set
+    :param files: List of paths to files to upload as attachments
+    :param files_limit: Total size in bytes the files of one message may take up, e.g. the guild's filesize_limit
+    :param ts: Slack timestamp of the message, deriving the nonces that keep retried sends from duplicating it.
+               Messages posted through a webhook can't carry a nonce.
+    :return: The first message sent
+    """
+    if not msg and not embeds and not files:
+        log.debug("Why are you here? - Skipping empty message")
         return None
-    
+
+    route = channel_route("POST", ctx, "/messages")
+    webhook = None
+    thread = None
+    if USE_WEBHOOKS and author:
+        channel = getattr(ctx, "channel", None) or ctx
+        if getattr(channel, "parent", None): # threads are posted to through their parent's webhook
+            thread, channel = channel, channel.parent
+        webhook = await webhooks.get(channel)
+        if webhook:
+            route = RateLimitScheduler.route_key("POST", f"/webhooks/{webhook.id}")
+            username = webhook_username(f"{author['username']} ({author['timestamp']})")
+        else:
+            header = format_header(author["username"], author["timestamp"])
+            msg = f"{header}\n{msg}" if msg else f"{header} - *Attachments:*"
+    msg = msg or ""
+    channel = getattr(ctx, "channel", None) or ctx
+    parts = iter(range(1 << 16))
+
+    async def attempt(func, *args, files=None, **kwargs):
+        # Files are opened for every attempt, as sending closes them
+        if files:
+            kwargs["files"] = await run_blocking(lambda: [discord.File(path, filename=os.path.basename(path)) for path in files])
+        return await func(*args, **kwargs)
+
+    async def send(content, reference=None, **kwargs):
+        if webhook:
+            # Webhooks are unable to reply, so references are dropped
+            if thread:
+                kwargs["thread"] = thread
+            # Webhook messages carry no nonce, so a retry could post them twice
+            return await current_scheduler.get().request(route, attempt, webhook.send, content or None, idempotent=False, username=username,
+                                           avatar_url=author["avatar_url"], wait=True, **kwargs)
+        nonce = message_nonce(channel, ts, next(parts)) if ts else None
+        # Without a nonce discord enforces (discord.py < 2 can't), a retry could post the message twice, as with webhooks
+        return await current_scheduler.get().request(route, attempt, send_with_nonce, channel, content, nonce, reference,
+                                                     idempotent=nonce is not None and discord.__version__[0] >= "2", **kwargs)
+
     first_ref = None
     last_ref = None
     # Split and send message *until* the remainder is within the limit, with references
-    bot_prefix = "*continuation:*\n"
-    while len(msg) > MAX_CHARACTERS:
-        ref = await ctx.send(msg[:MAX_CHARACTERS], reference=ref, allowed_mentions = allowed_mentions)
+    chunks = split_message(msg)
+    metrics.count("splits", len(chunks) - 1)
+    for chunk in chunks[:-1]:
+        ref = await send(chunk, reference=ref, allowed_mentions = allowed_mentions)
         first_ref = first_ref or ref
-        msg = bot_prefix+msg[MAX_CHARACTERS:] # tail
-        if THROTTLE:
-            time.sleep(THROTTLE_TIME_SECONDS)
-
-    # Send the remainder, with any embeds attached
-    if not embeds:
-        ref = await ctx.send(msg, reference=ref, allowed_mentions = allowed_mentions)
+    msg = chunks[-1]
+
+    # Send the remainder, with any embeds and files attached.
+    #  Attachments beyond the per-message limits are sent in additional messages, referencing their parent.
+    embeds = embeds or []
+    files = files or []
+    embed_batches = [embeds[i:i+MAX_EMBEDS] for i in range(0, len(embeds), MAX_EMBEDS)]
+    file_batches = await run_blocking(batch_files, files, files_limit) if files else []
+    if len(embed_batches) > 1 or len(file_batches) > 1:
+        log.debug("Message contains over %s embeds, or over %s files or their size limit - they will be split into multiple messages, referencing their parent.",
+                  MAX_EMBEDS, MAX_FILES)
+
+    for i in range(max(1, len(embed_batches), len(file_batches))):
+        kwargs = {}
+        if i < len(embed_batches):
+            if discord.__version__[0] >= "2":
+                kwargs["embeds"] = embed_batches[i]
+            else:
+                kwargs["embed"] = embed_batches[i][0]
+        if i < len(file_batches):
+            kwargs["files"] = file_batches[i]
+        ref = await send(msg, reference=last_ref or ref, allowed_mentions = allowed_mentions, **kwargs)
         first_ref = first_ref or ref
-        if THROTTLE:
-            time.sleep(THROTTLE_TIME_SECONDS)
-    else:
-        if len(embeds) > MAX_EMBEDS:
-            print(f"[INFO] Message contains over {MAX_EMBEDS} embeds.")
-            print(f"       They will be split into multiple messages,")
-            print(f"        referencing their parent.")
-
-        if discord.__version__[0] >= "2":
-            while embeds:
-                ref = await ctx.send(msg, embeds=embeds[:MAX_EMBEDS], reference=last_ref or ref, allowed_mentions = allowed_mentions)
-                first_ref = first_ref or ref
-                last_ref = last_ref or ref
-                if THROTTLE:
-                    time.sleep(THROTTLE_TIME_SECONDS)
-                msg = "*Additional attachments:*"
-                embeds=embeds[MAX_EMBEDS:] # tail
-        else:
-            for embed in embeds:
-                ref = await ctx.send(msg, embed=embed, reference=last_ref or ref, allowed_mentions = allowed_mentions)
-                first_ref = first_ref or ref
-                last_ref = last_ref or ref
-                if THROTTLE:
-                    time.sleep(THROTTLE_TIME_SECONDS)
-                msg = "*Additional attachments:*"
+        last_ref = last_ref or ref
+        if i:
+            metrics.count("splits")
+        msg = "*Additional attachments:*"
 
     return first_ref
 
 
-async def import_files(ctx, fs, users, slack2discord_users, channels):
+# Error code discord responds with when a message already has a thread
+THREAD_ALREADY_CREATED = 160004
+
+
+async def create_thread(message, name):
+    """
+    Creates a thread from a message, or returns its thread if already created by an attempt whose response was lost
+    :param message: Message to create the thread from
+    :param name: Name of the thread
+    :return: The thread
+    """
+    route = channel_route("POST", message, f"/messages/{message.id}/threads")
+    try:
+        return await current_scheduler.get().request(route, message.create_thread, name=name, reason="Migrating Slack thread")
+    except discord.HTTPException as e:
+        if e.code != THREAD_ALREADY_CREATED:
+            raise
+    log.debug("Thread was already created: %s", name)
+    # Threads created from a message share its id
+    return message.guild.get_thread(message.id) or await current_scheduler.get().request(
+        RateLimitScheduler.route_key("GET", f"/channels/{message.id}"), message.guild.fetch_channel, message.id)
+
+
+async def resume_thread(ctx, thread_id):
+    """
+    Fetches a thread (or thread-owner message if discord.py < 2.0) created by an earlier, interrupted import
+    :param ctx: Channel the thread belongs to
+    :param thread_id: Discord id of the thread or message
+    :return: The thread or message, or None if it no longer exists
+    """
+    try:
+        if discord.__version__[0] < "2":
+            return await current_scheduler.get().request(channel_route("GET", ctx, "/messages/:id"), ctx.fetch_message, thread_id)
+        thread = ctx.guild.get_thread(thread_id)
+        if not thread:
+            thread = await current_scheduler.get().request(channel_route("GET", discord.Object(thread_id)), ctx.guild.fetch_channel, thread_id)
+        return thread
+    except discord.HTTPException as e:
+        log.error(f"Unable to resume thread: {thread_id}\n        {e}")
+        return None
+
+
+def iter_messages(fs):
+    """
+    Yields the messages of slack .json logs, skipping logs that fail to load
+    :param fs: List of paths to .json logs, read in order of their (date) names
+    :return: Generator of message dicts
+    """
+    for json_file in sorted(fs):
+        log.debug("Parsing file: %s", json_file)
+        try:
+            yield from iter_json_array(json_file)
+        except OSError as e:
+            log.error(f"{e}")
+        except json.JSONDecodeError as e:
+            log.error(f"Unable to load json-file, skipping.\n  JSONDecodeError: {e}")
+
+
+def get_log_day(json_file):
+    """
+    :param json_file: Path to a .json log, named after the day of its messages (YYYY-MM-DD.json)
+    :return: Unix timestamp of the start of the day (UTC), or None if not named after a day
+    """
+    try:
+        return calendar.timegm(time.strptime(get_filename(json_file), "%Y-%m-%d"))
+    except ValueError:
+        return None
+
+
+def skip_imported_logs(fs, mark):
+    """
+    Leaves out the .json logs of days before an incremental import's mark, without reading them
+    :param fs: Sorted paths to .json logs
+    :param mark: Latest ts imported into the channel, or None
+    :return: List of the paths to import
+    """
+    if mark is None:
+        return fs
+    # The day of a log is not in UTC, but in the timezone of the export, so allow for a day of offset
+    logs = [f for f in fs if get_log_day(f) is None or get_log_day(f) + 2 * 86400 > mark]
+    if len(logs) < len(fs):
+        log.info(f"Skipping {len(fs) - len(logs)} of {len(fs)} .json logs, imported up to {datetime.fromtimestamp(mark)}")
+    return logs
+
+
+def batch_messages(messages, size=PARSE_BATCH):
+    """
+    :param messages: Iterable of messages
+    :param size: Number of messages per batch
+    :return: Generator of lists of at most `size` messages
+    """
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def prefetch(records, depth=PIPELINE_DEPTH):
+    """
+    Runs an async iterable in a background task, queueing up to `depth` of its items ahead of the consumer
+    :param records: Async iterable
+    :param depth: Maximum number of queued items
+    :return: Async generator of the items, re-raising any exception of the iterable once reached
+    """
+    queue = asyncio.Queue(depth)
+    done = object()
+
+    async def produce():
+        try:
+            async for record in records:
+                await queue.put(record)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(done)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            record = await queue.get()
+            if record is done:
+                break
+            if isinstance(record, Exception):
+                raise record
+            yield record
+    finally:
+        producer.cancel()
+
+
+async def import_files(ctx, sources, pool, journal=None, slack_channel=None, thread_manager=None, coalesce=None, attachments=None,
+                       marks=None, dead_letters=None):
+    """
+    Imports slack messages into a channel.
+    Messages are parsed by the pool and queued ahead of the sender, which sends them in order.
+    :param ctx: Context or channel to import into
+    :param sources: Iterable of paths to .json logs, or lists of messages as json strings, in the order they are to be imported
+    :param pool: ParsePool parsing the messages
+    :param journal: ImportJournal recording imported messages, to skip them if resumed
+    :param slack_channel: Name of the slack channel, keying its messages in the journal
+    :param thread_manager: ThreadManager archiving the channel's threads, shared between concurrent imports
+    :param coalesce: Window of seconds within which consecutive messages by the same user are merged, or None
+    :param attachments: AttachmentCache to download files through, uploading them rather than embedding links
+    :param marks: High-water marks of an incremental import (see ImportJournal.get_marks()), skipping the messages up to them
+    :param dead_letters: DeadLetters recording the messages that fail to send, which are then skipped rather than failing the channel
+    """
     # # dict mapping slack msg-id -> discord message for migrating replies.
     # # Appears slack does not have replies, so this dict is useless.
     # messages = {}
     # dict mapping slack thread_timestamp -> discord thread
     #  If discord.py < 2.0 this is instead used to reference thread-owner
     threads = {}
-    for json_file in sorted(fs):
-        print(f"[INFO] Parsing file: {json_file}")
-        try:
-            with open(json_file, encoding="utf-8") as f:
-                for message in json.load(f):
-                    print(f"[INFO] Parsing message:")
-                    parsed = parse_message(message, users)
-                    if parsed:
-                        msg_id, msg, files, thread_ts = parsed
-
-                        if msg:
-                            context = ctx
-                            thread_owner = None
-                            if not msg_id:
-                                print(f"[WARNING] No message-id found - will be unlinkable")
-                            msg = await fill_references(ctx, msg, users, slack2discord_users, channels)
-                            print(f"[INFO] Importing message: '{msg}'")
-                            if thread_ts:
-                                # Prefix to clarify message owns/belongs to thread
-                                prefix = "[Thread OP] "
-                                if thread_ts in threads:
-                                    print(f"[INFO] Message belongs to thread: {thread_ts}")
-                                    if discord.__version__[0] < "2":
-                                        # Emulating threads by converting it into a reply-chain
-                                        thread_owner = threads[thread_ts]
-                                        prefix = "[Thread] "
-                                    else:
-                                        context = threads[thread_ts]
-                                if discord.__version__[0] < "2":
-                                    msg = prefix + msg
-
-
-                            disable_notifications = discord.AllowedMentions.none()
-                            message = await send_message(context, msg, ref=thread_owner, embeds=files if files else None, allowed_mentions = disable_notifications)
-                            # messages[msg_id] = message
-
-                            if thread_ts:
-                                if not thread_ts in threads:
-                                    print(f"[INFO] Message owns a thread: {thread_ts}")
-                                    if discord.__version__[0] < "2":
-                                        print(f"       Contents will be sent directly to text-channel, referencing this, instead")
-                                        threads[thread_ts] = message
-                                    else:
-                                        print(f"       Creating thread")
-                                        threads[thread_ts] = await message.create_thread(name=thread_ts, reason="Migrating Slack thread")
-                                if discord.__version__[0] >= "2":
-                                    # Threads need to be archived after each message, as well as creation.
-                                    await threads[thread_ts].edit(archived=True)
-                            print(f"[INFO] Message imported!")
-
-                        if not msg and not files:
-                            print(f"[ERROR] skipping message - Found neither text nor files in message: {message}")
-                    else:
-                        print(f"[INFO] Ignored unparsed message.")
-                    print(f"") # empty line
-        except OSError as e:
-            print(f"[ERROR] {e}")
-        except json.JSONDecodeError as e:
-            print(f"[ERROR] Unable to load json-file, skipping.\n  JSONDecodeError: {e}")
-        print(f"") # extra empty line
+    thread_manager = thread_manager or ThreadManager()
+    channel_id = (getattr(ctx, "channel", None) or ctx).id
+    guild_id = ctx.guild.id
+    # Threads created by an earlier import, fetched once a message belongs to them
+    journaled_threads = await run_blocking(journal.get_threads, guild_id, slack_channel) if journal else {}
+    # dict mapping slack thread_timestamp -> error of its thread-owner message that failed to send.
+    #  Its replies are recorded in the dead letters along with it, rather than the first of them starting the thread.
+    failed_threads = {}
+    marks = marks or {}
+
+    def skip(record):
+        # Messages are imported in order, so everything up to the channel's mark was imported or left out before.
+        #  Replies imported along with their thread (--group-threads) can be newer, and are covered by the thread's mark.
+        ts = float(record["ts"])
+        thread_ts = record["thread"] if record["thread"] != record["ts"] else None
+        skipped = ts <= marks.get("", float("-inf")) or (thread_ts and ts <= marks.get(thread_ts, float("-inf"))) \
+            or (journal.is_imported(guild_id, slack_channel, record["ts"]) if journal else False)
+        if skipped:
+            metrics.count("skipped")
+        return skipped
+
+    def counted(sources):
+        # Pulled from a background thread, which does not see the current_channel of this task
+        for source in sources:
+            metrics.source(source, slack_channel)
+            yield source
+
+    records = pool.records(counted(sources), skip)
+    if coalesce:
+        records = coalesce_messages(records, coalesce)
+    if attachments:
+        records = download_attachments(records, attachments)
+    async for parsed in prefetch(records):
+        if parsed:
+            metrics.count("messages", 1 + len(parsed.get("coalesced", [])))
+            msg_id, msg, files, thread_ts = parsed["id"], parsed["msg"], parsed["files"], parsed["thread"]
+            if thread_ts and thread_ts not in threads and thread_ts in journaled_threads:
+                log.debug("Resuming thread: %s", parsed['thread_name'])
+                thread = await resume_thread(ctx, journaled_threads.pop(thread_ts))
+                if thread:
+                    threads[thread_ts] = thread
+
+            if (msg or files) and thread_ts in failed_threads and thread_ts not in threads:
+                log.error(f"Thread owner of message {parsed['ts']} failed to send - recorded in the dead letters",
+                          extra=summary("Thread owner failed to send"))
+                coalesced = 1 + len(parsed.get("coalesced", []))
+                metrics.count("messages", -coalesced)
+                metrics.count("failed", coalesced)
+                await run_blocking(dead_letters.add, guild_id, slack_channel, parsed, failed_threads[thread_ts])
+            elif msg or files:
+                context = ctx
+                thread_owner = None
+                if not msg_id:
+                    log.warning(f"No message-id found - will be unlinkable", extra=summary("No message-id found"))
+                log.debug("Importing message: '%s'", msg)
+                if thread_ts:
+                    # Prefix to clarify message owns/belongs to thread
+                    prefix = "[Thread OP] "
+                    if thread_ts in threads:
+                        log.debug("Message belongs to thread: %s", thread_ts)
+                        if discord.__version__[0] < "2":
+                            # Emulating threads by converting it into a reply-chain
+                            thread_owner = threads[thread_ts]
+                            prefix = "[Thread] "
+                        else:
+                            context = threads[thread_ts]
+                    if discord.__version__[0] < "2":
+                        msg = prefix + msg
+
+
+                uploads = None
+                if parsed.get("downloads"):
+                    # Upload the files that were downloaded, and keep embedding links to those that weren't
+                    paths = await parsed["downloads"]
+                    limit = ctx.guild.filesize_limit
+                    sizes = await run_blocking(lambda: [p and os.path.getsize(p) for p in paths])
+                    uploads = [p for p, size in zip(paths, sizes) if p and size <= limit]
+                    files = [e for e, p, size in zip(files, paths, sizes) if not (p and size <= limit)]
+
+                disable_notifications = discord.AllowedMentions.none()
+                try:
+                    message = await send_message(context, msg, ref=thread_owner, embeds=files if files else None, allowed_mentions = disable_notifications, author=parsed["author"], files=uploads, ts=parsed["ts"], files_limit=ctx.guild.filesize_limit)
+                except SEND_ERRORS as e:
+                    if dead_letters is None:
+                        raise
+                    log.error(f"Failed to send message {parsed['ts']} - recorded in the dead letters\n"
+                              f"        {type(e).__name__}: {e}", extra=summary("Failed to send message"))
+                    coalesced = 1 + len(parsed.get("coalesced", []))
+                    metrics.count("messages", -coalesced)
+                    metrics.count("failed", coalesced)
+                    await run_blocking(dead_letters.add, guild_id, slack_channel, parsed, e)
+                    if thread_ts and thread_ts not in threads:
+                        failed_threads[thread_ts] = e
+                    continue
+                # messages[msg_id] = message
+
+                if thread_ts:
+                    if not thread_ts in threads:
+                        log.debug("Message owns a thread: %s", thread_ts)
+                        if discord.__version__[0] < "2":
+                            log.debug("Thread contents will be sent directly to text-channel, referencing this, instead")
+                            threads[thread_ts] = message
+                        else:
+                            log.debug("Creating thread")
+                            threads[thread_ts] = await create_thread(message, parsed["thread_name"])
+                            metrics.count("threads")
+                        if journal:
+                            await run_blocking(journal.record_thread, guild_id, slack_channel, thread_ts, threads[thread_ts].id)
+                    if discord.__version__[0] >= "2":
+                        # Threads stay open while receiving replies, and are archived once evicted or the channel is done.
+                        await thread_manager.touch(threads[thread_ts], channel_id)
+                # Journaled only once its thread exists, so a resumed import never loses the thread
+                if journal and message:
+                    await run_blocking(journal.record_messages, guild_id, slack_channel,
+                                       list(filter(None, [parsed["ts"]] + parsed.get("coalesced", []))), message.id, thread_ts)
+                log.debug("Message imported!")
+
+            if not msg and not files:
+                log.error(f"skipping message - Found neither text nor files in message: {parsed}", extra=summary("Found neither text nor files in message"))
+    await thread_manager.close_channel(channel_id)
     # return messages
 
-async def import_slack_directory(ctx, path, slack_dir, match_channel=True):
+def parse_date(value, end_of_day=False):
+    """
+    Parses a date of the form YYYY-MM-DD (local time), or a unix timestamp
+    :param value: String to parse
+    :param end_of_day: Whether a date refers to the end of that day, rather than its start
+    :return: Unix timestamp, or None if unparsable
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return None
+    return date.timestamp() + (24*60*60 if end_of_day else 0)
+
+
+def parse_import_options(args):
+    """
+    Separates the paths given to an import command from its options:\n
+    --since <date>    Only import messages sent on or after the date (YYYY-MM-DD or unix timestamp)\n
+    --until <date>    Only import messages sent on or before the date\n
+    --user <user>     Only import messages sent by the slack user (id or name)\n
+    --threads-only    Only import messages that own or belong to a thread\n
+    --group-threads   Import thread replies directly after their parent, even if sent days later\n
+    --coalesce <s>    Merge consecutive messages by the same user sent within <s> seconds into one message\n
+    --download-files  Upload slack files to discord as attachments, rather than embedding links to them\n
+    --incremental     Only import messages newer than the last import of their channel or thread\n
+    --dead-letters    Only import the messages that failed to send before (see DeadLetters)\n
+    Messages are selected from the index of the slack-log directory when any filtering option is given.
+    :param args: Arguments of the command
+    :return: Tuple of the list of paths and the dict of options, or None if the options are invalid
+    """
+    paths = []
+    filters = {}
+    args = iter(args)
+    for arg in args:
+        if arg in ["--since", "--until"]:
+            value = next(args, "")
+            timestamp = parse_date(value, end_of_day=(arg == "--until"))
+            if timestamp is None:
+                log.error(f"Invalid date for {arg}: '{value}' - expected YYYY-MM-DD or a unix timestamp")
+                return None
+            filters[arg[2:]] = timestamp
+        elif arg == "--user":
+            filters["user"] = next(args, None)
+        elif arg == "--threads-only":
+            filters["threads_only"] = True
+        elif arg == "--group-threads":
+            filters["group_threads"] = True
+        elif arg == "--download-files":
+            filters["download_files"] = True
+        elif arg == "--incremental":
+            filters["incremental"] = True
+        elif arg == "--dead-letters":
+            filters["dead_letters"] = True
+        elif arg == "--coalesce":
+            value = next(args, "")
+            try:
+                filters["coalesce"] = float(value)
+            except ValueError:
+                log.error(f"Invalid number of seconds for {arg}: '{value}'")
+                return None
+        elif arg.startswith("--"):
+            log.error(f"Unknown option: {arg}")
+            return None
+        else:
+            paths.append(arg)
+    return paths, filters
+
+
+async def import_slack_directory(ctx, path, slack_dir, match_channel=True, filters=None, resume=True):
+    """
+    Imports the channels of a parsed slack-log directory
+    :param ctx: Context of the command
+    :param path: Path the directory was parsed from
+    :param slack_dir: Dict representing the slack-log directory
+    :param match_channel: Whether to import each channel into its namesake, rather than the context's channel
+    :param filters: Dict of filters selecting which messages to import (see MessageStore.query()),
+                    as well as the "coalesce" window (see coalesce_messages()) and whether to "download_files",
+                    import "incremental"ly, or only import the "dead_letters"
+    :param resume: Whether to skip messages recorded in the journal, and record the imported ones,
+                   along with the dead letters and metrics, in the slack-root
+    :return: Whether every channel was imported
+    """
     if not ctx:
-        print(f"[ERROR] Import aborted - No context was given!")
+        log.error(f"Import aborted - No context was given!")
     if not slack_dir:
-        print(f"[ERROR] Import aborted - Failed to parse any slack-log directory at {path}")
+        log.error(f"Import aborted - Failed to parse any slack-log directory at {path}")
     elif not slack_dir["history"]:
-        print(f"[ERROR] Import aborted - No .json files found at {path}")
+        log.error(f"Import aborted - No .json files found at {path}")
     else:
         if match_channel == True:
-            print(f"[INFO] Creating missing channels to facilitate channel-references")
+            log.info(f"Creating missing channels to facilitate channel-references")
             for ch in slack_dir["history"]:
-                print(f"[INFO] Checking channel: {ch}")
+                log.info(f"Checking channel: {ch}")
                 await get_or_create_channel(ctx, ch)
 
-        print(f"[INFO] Importing channels")
-        users, slack2discord_users, channels = parse_important_files(slack_dir)
-        for ch, fs in slack_dir["history"].items():
-            print(f"[INFO] Importing channel: {ch}")
-            if match_channel == True:
-                ctx = await get_or_create_channel(ctx, ch)
-            await import_files(ctx, fs, users, slack2discord_users, channels)
-            print(f"[INFO] Completed importing channel: {ch}")
-        print(f"[INFO] Import complete")
+        log.info(f"Importing channels")
+        plan = slack_dir.get("plan")
+        if plan:
+            users, slack2discord_users, channels, avatars = (plan.header[k] for k in ("users", "slack2discord_users", "channels", "avatars"))
+        else:
+            users, slack2discord_users, channels = await run_blocking(parse_important_files, slack_dir)
+            avatars = (await run_blocking(LookupTables.open, slack_dir)).tables["avatars"] if USE_WEBHOOKS else None
+        mentioned = plan.mentions if plan else await run_blocking(find_mentions, slack_dir)
+        await resolve_members(ctx.guild, mentioned_names(users, slack2discord_users, mentioned))
+        references = build_reference_table(ctx, users, slack2discord_users, channels, mentioned)
+        filters = dict(filters or {})
+        coalesce = filters.pop("coalesce", COALESCE_WINDOW_SECONDS)
+        incremental = filters.pop("incremental", INCREMENTAL)
+        dead_letters = DeadLetters(os.path.join(slack_dir["state"], DEAD_LETTERS_NAME) if resume else None)
+        replay = None
+        if filters.pop("dead_letters", False):
+            replay = {ch: ts for ch, ts in (await run_blocking(dead_letters.select, ctx.guild.id)).items() if ch in slack_dir["history"]}
+            log.info(f"Importing {sum(map(len, replay.values()))} messages from the dead letters: {dead_letters.path}")
+            slack_dir = dict(slack_dir, history={ch: fs for ch, fs in slack_dir["history"].items() if ch in replay})
+            if plan:
+                plan.select(replay)
+        # Everything up to a mark is taken as imported, so imports leaving out older messages must not advance the marks.
+        #  --until only leaves out newer messages, which stay after the mark.
+        selection = plan.header["options"] if plan else filters
+        selective = replay is not None or any(selection.get(f) for f in ("since", "user", "threads_only"))
+        journal = await run_blocking(ImportJournal, os.path.join(slack_dir["state"], JOURNAL_NAME) if resume else ":memory:",
+                                     not selective)
+        log.info(f"Recording imported messages in journal: {journal.path}")
+        if selective:
+            log.info(f"Selective import - the high-water marks of incremental imports are left as they are")
+        attachments = None
+        if filters.pop("download_files", DOWNLOAD_FILES):
+            attachments = await run_blocking(AttachmentCache, os.path.join(slack_dir["state"], FILE_CACHE_NAME))
+            log.info(f"Downloading files into: {attachments.path}")
+        store = None
+        if not plan and (filters or replay is not None):
+            store = await run_blocking(MessageStore, os.path.join(slack_dir["state"], INDEX_NAME))
+            log.info(f"Indexing messages: {store.path}")
+            await run_blocking(store.index, slack_dir["history"])
+            if filters.get("user") and users and filters["user"] not in users:
+                # Allow selecting users by name, rather than only by id
+                uid = next((uid for uid, name in users.items() if name == filters["user"]), None)
+                if uid:
+                    filters["user"] = uid
+        # Each channel is assigned to one of the bots by its name, so a resumed import sends it through the same bot.
+        #  Every bot's workers pull channels from a shared iterator, each importing its channel's files in order.
+        #  The largest channels are started first, so the workers finish at about the same time.
+        #  Without matching channels everything goes to the same channel, so only one worker of the main bot is used.
+        sizes = slack_dir.get("sizes", {})
+        log.info(f"Importing {len(slack_dir['history'])} channels, {sum(sizes.values()) / 2**20:.1f} MiB of .json logs")
+        bots = [Sender("main bot")]
+        if match_channel == True:
+            bots += await connect_senders()
+            order = sorted(slack_dir["history"], key=lambda ch: sizes.get(ch, 0), reverse=True)
+        else:
+            order = list(slack_dir["history"])
+        assigned = {bot: [ch for ch in order if zlib.crc32(ch.encode()) % len(bots) == i] for i, bot in enumerate(bots)}
+        completed = {bot: 0 for bot in bots}
+        started = {bot: (bot.scheduler.requests, bot.scheduler.waited) for bot in bots}
+        failures = {}
+        thread_manager = ThreadManager()
+        if plan:
+            plan.references = references
+            pool = plan
+        else:
+            pool = ParsePool(users, avatars, references)
+
+        async def worker(bot, pending):
+            current_scheduler.set(bot.scheduler)
+            for ch in pending:
+                log.info(f"Importing channel: {ch}" + (f" ({bot.name})" if len(bots) > 1 else ""))
+                current_channel.set(ch)
+                metrics.channel(ch)["state"] = "importing"
+                try:
+                    target = ctx
+                    if match_channel == True:
+                        target = await bot.resolve(await get_or_create_channel(ctx, ch))
+                    marks = await run_blocking(journal.get_marks, target.guild.id, ch) if incremental else {}
+                    if plan:
+                        metrics.channel(ch)["messages_total"] = len(replay[ch]) if replay is not None else plan.counts[ch]
+                        sources = slack_dir["history"][ch]
+                    elif store:
+                        query = dict(filters)
+                        if replay is not None:
+                            query["ts_in"] = replay[ch]
+                        if "" in marks:
+                            query["since"] = max(query.get("since") or marks[""], marks[""])
+                        metrics.channel(ch)["messages_total"] = await run_blocking(functools.partial(store.count, ch, **query))
+                        sources = batch_messages(store.query(ch, raw=True, **query))
+                    else:
+                        sources = skip_imported_logs(sorted(slack_dir["history"][ch]), marks.get(""))
+                    await import_files(target, sources, pool, journal, ch, thread_manager, coalesce, attachments, marks, dead_letters)
+                except Exception as e:
+                    failures[ch] = e
+                    metrics.channel(ch)["state"] = "failed"
+                    log.error(f"Failed to import channel: {ch}\n        {type(e).__name__}: {e}")
+                else:
+                    metrics.channel(ch)["state"] = "done"
+                    log.info(f"Completed importing channel: {ch}")
+                completed[bot] += 1
+            current_channel.set(None)
+
+        def log_progress():
+            log.info(f"Progress: {sum(completed.values())}/{len(order)} channels\n" + "\n".join(
+                f"       {bot.name}: {completed[bot]}/{len(assigned[bot])} channels, "
+                f"{bot.scheduler.requests - started[bot][0]} requests, "
+                f"waited {timedelta(seconds=round(bot.scheduler.waited - started[bot][1]))} on rate limits"
+                for bot in bots))
+
+        metrics_path = METRICS_FILE or (os.path.join(slack_dir["state"], METRICS_NAME) if resume else None)
+        metrics.start(order, sizes)
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+                log_progress()
+                if metrics_path:
+                    await run_blocking(metrics.write, metrics_path)
+
+        workers = []
+        for bot, channels_of_bot in assigned.items():
+            pending = iter(channels_of_bot)
+            count = IMPORT_WORKERS if match_channel == True else 1
+            workers += [worker(bot, pending) for _ in range(min(count, len(channels_of_bot)))]
+        progress = asyncio.ensure_future(report_progress())
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            progress.cancel()
+            metrics.finish()
+        log_progress()
+        if metrics_path:
+            await run_blocking(metrics.write, metrics_path)
+            log.info(f"Metrics written to: {metrics_path}")
+        # Archive threads left open by channels that failed
+        await thread_manager.close()
+        pool.close()
+        left = await run_blocking(dead_letters.prune, journal)
+        if left:
+            log.warning(f"{left} messages failed to send, and are recorded in the dead letters: {dead_letters.path}\n"
+                        f"        Import them again with the --dead-letters option")
+        await run_blocking(journal.close)
+        if attachments:
+            await attachments.close()
+        if store:
+            store.close()
+        if failures:
+            log.error(f"{len(failures)} of {len(slack_dir['history'])} channels failed to import:\n" +
+                      "\n".join(f"        {ch}: {type(e).__name__}: {e}" for ch, e in failures.items()))
+        summary_filter.summarize()
+        log.info(f"Import complete")
+        return not failures
+    return False
+
+
+async def dry_run(args):
+    """
+    Runs an import_all against a local stand-in for discord, reporting the requests it would make
+    and an estimate of how long it would take. Nothing is sent to discord, and the journal is left untouched.
+    Metrics are only written if given a --metrics-file.
+    :param args: Path to the slack-log directory or an import plan, followed by any import options
+    """
+    global THROTTLE
+    options = parse_import_options(args)
+    if not options or not options[0]:
+        log.error(f"Usage: slack2discord.py --dry-run <path> [options]")
+        return
+    paths, filters = options
+    THROTTLE = False # rate limits are simulated on the transport's virtual clock instead
+    transport = DryRunTransport()
+    ctx = DryRunContext(transport)
+    log.info(f"Dry-run of importing '{paths[0]}'")
+    if PlanReader.is_plan(paths[0]):
+        slack_dir = await load_plan(paths[0], filters)
+    else:
+        slack_dir = await parse_slack_directory(paths[0], force_all=True)
+    await import_slack_directory(ctx, paths[0], slack_dir, filters=filters, resume=False)
+    transport.report()
+
+
+def plan_line(record):
+    """
+    :param record: Parsed message, see parse_message()
+    :return: "message" line of an import plan, holding what is needed to send the message
+    """
+    return json.dumps({"op": "message", "id": record["id"], "ts": record["ts"], "thread": record["thread"],
+                       "thread_name": record["thread_name"], "msg": record["msg"] or "",
+                       "embeds": [e.to_dict() for e in record["files"] or []], "attachments": record["attachments"],
+                       "author": record["author"], "coalesced": record.get("coalesced", [])}) + "\n"
+
+
+async def compile_plan(plan_path, args):
+    """
+    Compiles a slack-log directory into an import plan, which !import_plan replays into a server without parsing the export.
+    Channels are parsed by the parse pool, IMPORT_WORKERS at a time, each into a temporary file appended to the plan
+    once complete. Compiling into an existing plan of the same export only compiles the channels missing from it.
+    @mentions and #channels are left to be resolved against the server the plan is imported into,
+    and message headers are formatted for USE_WEBHOOKS as set when compiling.
+    :param plan_path: Path to the plan
+    :param args: Path to the slack-log directory, followed by any options selecting its messages (see parse_import_options())
+    :return: Whether every channel was compiled
+    """
+    options = parse_import_options(args)
+    if not options or not options[0]:
+        log.error(f"Usage: slack2discord.py --compile <plan> <path> [options]")
+        return False
+    paths, filters = options
+    coalesce = filters.pop("coalesce", COALESCE_WINDOW_SECONDS)
+    for option in ("download_files", "incremental", "dead_letters"):
+        if filters.pop(option, False):
+            log.error(f"--{option.replace('_', '-')} is an option of importing a plan, rather than compiling it")
+            return False
+    slack_dir = await parse_slack_directory(paths[0], force_all=True)
+    if not slack_dir:
+        log.error(f"Compilation aborted - Failed to parse any slack-log directory at {paths[0]}")
+        return False
+    users, slack2discord_users, channels = await run_blocking(parse_important_files, slack_dir)
+    avatars = (await run_blocking(LookupTables.open, slack_dir)).tables["avatars"] if USE_WEBHOOKS else None
+
+    compiled = {}
+    if os.path.exists(plan_path):
+        reader = await run_blocking(PlanReader(plan_path).scan)
+        if reader.header["root"] != slack_dir["root"]:
+            log.error(f"The plan was compiled from another export: {reader.header['root']}")
+            return False
+        compiled = reader.counts
+        log.info(f"Appending to plan of {len(compiled)} channels: {plan_path}")
+    else:
+        header = {"op": "plan", "version": PLAN_VERSION, "created": time.time(), "root": slack_dir["root"],
+                  "state": slack_dir["state"], "webhooks": USE_WEBHOOKS, "options": dict(filters, coalesce=coalesce),
+                  "users": users, "slack2discord_users": slack2discord_users, "channels": channels, "avatars": avatars}
+        with open(plan_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+
+    store = None
+    if filters:
+        store = await run_blocking(MessageStore, os.path.join(slack_dir["state"], INDEX_NAME))
+        await run_blocking(store.index, slack_dir["history"])
+        if filters.get("user") and users and filters["user"] not in users:
+            filters["user"] = next((uid for uid, name in users.items() if name == filters["user"]), filters["user"])
+    sizes = slack_dir["sizes"]
+    pending = iter(sorted((ch for ch in slack_dir["history"] if ch not in compiled), key=lambda ch: sizes.get(ch, 0), reverse=True))
+    plan_lock = asyncio.Lock()
+    pool = ParsePool(users, avatars, None)
+    failures = {}
+
+    async def worker(index):
+        part_path = f"{plan_path}.{index}.part"
+        for ch in pending:
+            log.info(f"Compiling channel: {ch}")
+            try:
+                if store:
+                    sources = batch_messages(store.query(ch, raw=True, **filters))
+                else:
+                    sources = sorted(slack_dir["history"][ch])
+                records = pool.records(sources)
+                if coalesce:
+                    records = coalesce_messages(records, coalesce)
+                count, mentions = 0, set()
+                with open(part_path, "w", encoding="utf-8") as part:
+                    part.write(json.dumps({"op": "channel", "name": ch}) + "\n")
+                    async for record in records:
+                        part.write(plan_line(record))
+                        mentions.update(MENTION_PATTERN.findall(record["msg"] or ""))
+                        count += 1 + len(record.get("coalesced", []))
+                    part.write(json.dumps({"op": "end", "channel": ch, "messages": count, "mentions": sorted(mentions)}) + "\n")
+                async with plan_lock:
+                    await run_blocking(append_file, part_path, plan_path)
+            except Exception as e:
+                failures[ch] = e
+                log.error(f"Failed to compile channel: {ch}\n        {type(e).__name__}: {e}")
+            else:
+                log.info(f"Compiled channel: {ch} ({count} messages)")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    try:
+        await asyncio.gather(*[worker(i) for i in range(IMPORT_WORKERS)])
+    finally:
+        pool.close()
+        if store:
+            store.close()
+    summary_filter.summarize()
+    if failures:
+        log.error(f"{len(failures)} channels failed to compile, and are compiled by compiling into the plan again")
+    log.info(f"Compiled plan: {plan_path}")
+    return not failures
+
+
+def append_file(source, destination):
+    """
+    Appends a file of lines to another, first truncating a last line that was cut short (e.g. by an interrupted append)
+    so the appended lines never continue it
+    :param source: Path to the file to append
+    :param destination: Path to the file to append to
+    """
+    with open(source, "rb") as src, open(destination, "r+b") as dst:
+        end = dst.seek(0, os.SEEK_END)
+        offset = end
+        while offset > 0:
+            start = max(0, offset - (1 << 16))
+            dst.seek(start)
+            newline = dst.read(offset - start).rfind(b"\n")
+            if newline >= 0:
+                offset = start + newline + 1
+                break
+            offset = start
+        if offset < end:
+            log.warning(f"Dropping a line cut short at the end of: {destination}")
+            dst.truncate(offset)
+        dst.seek(offset)
+        shutil.copyfileobj(src, dst)
+
+
+async def load_plan(plan_path, filters):
+    """
+    :param plan_path: Path to an import plan
+    :param filters: Options the plan is imported with
+    :return: Dict representing the plan as a slack-log directory (see PlanReader.slack_dir()), or None if unusable
+    """
+    unsupported = [f"--{option.replace('_', '-')}" for option in filters
+                   if option not in ("download_files", "incremental", "dead_letters")]
+    if unsupported:
+        log.error(f"Options {', '.join(unsupported)} are applied when compiling a plan, rather than importing it")
+        return None
+    try:
+        plan = await run_blocking(PlanReader(plan_path).scan)
+    except (OSError, ValueError) as e:
+        log.error(f"Unable to read import plan: {e}")
+        return None
+    if plan.header["webhooks"] != USE_WEBHOOKS:
+        log.warning(f"The plan was compiled with USE_WEBHOOKS={plan.header['webhooks']}, so its messages are formatted for that")
+    log.info(f"Importing plan of {len(plan.blocks)} channels, {sum(plan.counts.values())} messages: {plan_path}")
+    return plan.slack_dir()
+
+
+async def run_import(ctx, command, args):
+    """
+    Runs an import command, as invoked from discord or the command line
+    :param ctx: Context (or channel) the command was invoked from
+    :param command: Name of the command, "import_all", "import_path", "import_here" or "import_plan"
+    :param args: Paths and options given to the command, see parse_import_options()
+    :return: Whether everything was imported
+    """
+    if command not in ("import_all", "import_path", "import_here", "import_plan"):
+        log.error(f"Unknown command: {command} - expected import_all, import_path, import_here or import_plan")
+        return False
+    options = parse_import_options(args)
+    if not options:
+        return False
+    paths, filters = options
+    if not paths:
+        log.error(f"Usage: {command} <path> [options]")
+        return False
+
+    if command == "import_plan":
+        slack_dir = await load_plan(paths[0], filters)
+        return await import_slack_directory(ctx, paths[0], slack_dir, filters=filters) if slack_dir else False
+
+    if command == "import_all":
+        path = paths[0]
+        log.info(f"Attempting to import '{path}' to server '#{ctx.guild.name}'")
+        slack_dir = await parse_slack_directory(path, force_all=True)
+
+        return await import_slack_directory(ctx, path, slack_dir, filters=filters)
+
+    if command == "import_path":
+        log.info(f"Attempting to import '{paths}' to server '#{ctx.guild.name}'")
+        slack_dir = await parse_slack_directory(paths[0])
+        if not slack_dir:
+            log.error(f"Failed to parse slack directory")
+            return False
+
+        for path in paths[1:]:
+            slack_dir_2 = await parse_slack_directory(path)
+            for k, v in slack_dir_2["history"].items():
+                slack_dir["history"][k] = slack_dir["history"].get(k,[]) + v
+                slack_dir["sizes"][k] = slack_dir["sizes"].get(k, 0) + slack_dir_2["sizes"].get(k, 0)
+
+        return await import_slack_directory(ctx, slack_dir["root"], slack_dir, filters=filters)
+
+    else: # import_here
+        imported = True
+        for path in paths:
+            log.info(f"Attempting to import '{path}' to channel '#{ctx.channel.name}'")
+            slack_dir = await parse_slack_directory(path)
+            imported = await import_slack_directory(ctx, path, slack_dir, match_channel=False, filters=filters) and imported
+        return imported
+
+
+class HeadlessContext:
+    """
+    Stand-in for the context of an import command run from the command line, rather than invoked from discord
+    """
+    def __init__(self, guild, channel=None):
+        self.guild = guild
+        self.channel = channel
+        if channel:
+            self.send = channel.send
 
 
 def register_commands():
@@ -620,12 +3843,7 @@ def register_commands():
         :param path:
         :return:
         """
-        paths = list(kwpath)
-        path = paths[0]
-        print(f"[INFO] Attempting to import '{path}' to server '#{ctx.message.guild.name}'")
-        slack_dir = await parse_slack_directory(path, force_all=True)
-        
-        await import_slack_directory(ctx, path, slack_dir)
+        await run_import(ctx, "import_all", kwpath)
 
     @bot.command(pass_context=True)
     async def import_path(ctx, *kwpath):
@@ -639,20 +3857,7 @@ def register_commands():
         :param path:
         :return:
         """
-        paths = list(kwpath)
-        
-        print(f"[INFO] Attempting to import '{paths}' to server '#{ctx.message.guild.name}'")
-        slack_dir = await parse_slack_directory(paths[0])
-        if not slack_dir:
-            print(f"[ERROR] Failed to parse slack directory")
-            return
-
-        for path in paths[1:]:
-            slack_dir_2 = await parse_slack_directory(path)
-            for k, v in slack_dir_2["history"].items():
-                slack_dir["history"][k] = slack_dir["history"].get(k,[]) + v
-            
-        await import_slack_directory(ctx, slack_dir["root"], slack_dir)
+        await run_import(ctx, "import_path", kwpath)
 
     @bot.command(pass_context=True)
     async def import_here(ctx, *kwpath):
@@ -664,19 +3869,138 @@ def register_commands():
         :param path:
         :return:
         """
-        paths = list(kwpath)
-        for path in paths:
-            print(f"[INFO] Attempting to import '{path}' to channel '#{ctx.message.channel.name}'")
-            slack_dir = await parse_slack_directory(path)
-            await import_slack_directory(ctx, path, slack_dir, match_channel=False)
+        await run_import(ctx, "import_here", kwpath)
+
+    @bot.command(pass_context=True)
+    async def import_plan(ctx, *kwpath):
+        """
+        Imports an import plan compiled with --compile (relative to the bot) into the server, without parsing the export.
+        Each channel of the plan is imported into its namesake, which is created if it doesn't exist.
+        :param ctx:
+        :param path:
+        :return:
+        """
+        await run_import(ctx, "import_plan", kwpath)
+
+    @bot.command(pass_context=True)
+    async def import_status(ctx):
+        """
+        Reports the progress of the running (or last) import: channels, messages, sends, rate-limit waits and ETA
+        :param ctx:
+        :return:
+        """
+        for chunk in split_message(metrics.format()):
+            await ctx.send(chunk)
+
+
+def register_headless(command, guild_id=None, channel_id=None):
+    """
+    Runs an import command once the bot is connected, then stops the bot
+    :param command: List of the command's name and arguments, e.g. ["import_all", "<path>", "--since", "2021-01-01"]
+    :param guild_id: Id of the server to import into
+    :param channel_id: Id of the channel to import into, and run the command from
+    :return: Dict whose "imported" is set to whether everything was imported, once the bot has stopped
+    """
+    result = {"imported": False}
+
+    @bot.event
+    async def on_ready():
+        if "started" in result:
+            return # reconnected
+        result["started"] = True
+        try:
+            channel = None
+            if channel_id:
+                channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+            guild = channel.guild if channel else (bot.get_guild(guild_id) or await bot.fetch_guild(guild_id))
+            if command[0] == "import_here" and not channel:
+                log.error(f"import_here requires --channel")
+            else:
+                result["imported"] = await run_import(HeadlessContext(guild, channel), command[0], command[1:])
+        except discord.HTTPException as e:
+            log.error(f"Unable to find the server or channel to import into\n        {e}")
+        finally:
+            await close_senders()
+            await bot.close()
+
+    return result
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Slack message history importer for Discord",
+        epilog="Without a command the bot is started, and imports are invoked from discord with !import_all, !import_path, "
+               "!import_here or !import_plan. Given a command (e.g. `import_all <path> [options]`) and --guild or --channel, "
+               "the bot instead runs that import, and exits once it is done.",
+        allow_abbrev=False)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="simulate importing the given path (or plan) and options offline, instead of starting the bot")
+    parser.add_argument("--compile", metavar="PLAN",
+                        help="compile the given path and options into an import plan offline, instead of starting the bot")
+    parser.add_argument("--config", help="JSON file with defaults of these options, keyed by \"token\", \"sender_tokens\" (a list), "
+                                         "\"guild\", \"channel\", \"yes\" (true or false), \"log_level\" (e.g. \"WARNING\"), "
+                                         "\"log_file\", \"metrics_file\", \"dry_run\" or \"compile\", and the command as a list "
+                                         "under \"command\" (e.g. {\"token\": ..., \"guild\": ..., \"yes\": true, "
+                                         "\"command\": [\"import_all\", \"<path>\"]})")
+    parser.add_argument("--token", default=os.environ.get("DISCORD_TOKEN"),
+                        help="bot token (default: $DISCORD_TOKEN, otherwise asked for)")
+    parser.add_argument("--sender-token", action="append", dest="sender_tokens", metavar="TOKEN",
+                        default=[t for t in os.environ.get("DISCORD_SENDER_TOKENS", "").split(",") if t],
+                        help="token of an additional bot in the same server, importing part of the channels in parallel "
+                             "(can be given several times, default: the comma-separated $DISCORD_SENDER_TOKENS)")
+    parser.add_argument("--guild", type=int, help="id of the server to run the command in")
+    parser.add_argument("--channel", type=int, help="id of the channel to run the command from (required by import_here)")
+    answers = parser.add_mutually_exclusive_group()
+    answers.add_argument("-y", "--yes", action="store_const", const=True, default=ASSUME_YES,
+                         help="continue without missing root files, or with the path as root, without asking")
+    answers.add_argument("-n", "--no", action="store_const", dest="yes", const=False,
+                         help="abort on missing root files, or an unlocatable root, without asking")
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-q", "--quiet", action="store_const", dest="log_level", const=logging.WARNING,
+                           default=LOG_LEVEL, help="only log warnings and errors")
+    verbosity.add_argument("-v", "--verbose", action="store_const", dest="log_level", const=logging.DEBUG,
+                           help="also log the progress of every message")
+    parser.add_argument("--log-file", help="also write the log to this file, as JSON-lines")
+    parser.add_argument("--metrics-file", default=METRICS_FILE,
+                        help=f"write the metrics of imports to this file, in the Prometheus textfile format if it ends "
+                             f"with .prom (default: {METRICS_NAME} in the slack-root)")
+    args, rest = parser.parse_known_args()
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+        parser.set_defaults(**config)
+        args, rest = parser.parse_known_args()
+        rest = rest or config.get("command", [])
+    setup_logging(args.log_level, args.log_file)
     check_optional_dependencies()
+    ASSUME_YES = args.yes
+    SENDER_TOKENS = args.sender_tokens
+    METRICS_FILE = args.metrics_file
+    if args.dry_run:
+        asyncio.run(dry_run(rest))
+        sys.exit()
+    if args.compile:
+        sys.exit(0 if asyncio.run(compile_plan(args.compile, rest)) else 1)
+    if rest and not (args.guild or args.channel):
+        parser.error(f"--guild or --channel is required to run {rest[0]}")
+    token = args.token
+    if not token and sys.stdin.isatty():
+        token = input("Enter bot token: ")
+    if not token:
+        parser.error("no bot token given, pass --token or set DISCORD_TOKEN")
     intents = discord.Intents.default()
     intents.members = True
     if discord.__version__[0] >= "2":
         intents.message_content = True
-    bot = commands.Bot(command_prefix="!", intents=intents)
+    # Members are looked up when mentioned by an import (see resolve_members()), rather than all fetched at startup
+    options = {"chunk_guilds_at_startup": False}
+    if discord.__version__[0] >= "2":
+        # Feed discord's rate-limit headers into the scheduler
+        options["http_trace"] = scheduler.trace_config()
+    bot = commands.Bot(command_prefix="!", intents=intents, **options)
+    if rest:
+        result = register_headless(rest, args.guild, args.channel)
+        bot.run(token)
+        sys.exit(0 if result["imported"] else 1)
     register_commands()
-    bot.run(input("Enter bot token: "))
+    bot.run(token)
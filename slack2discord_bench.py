@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# Benchmarks of the slack2discord import pipeline, run against a generated Slack export and a local stand-in for discord.
+# Every stage is timed separately (locating the export, parsing, filling references, splitting, and importing),
+# and the results are written as JSON, so they can be compared against an earlier run (see --baseline).
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import string
+import sys
+import tempfile
+import time
+import discord
+import slack2discord
+
+# Defaults of the generated export, see generate_export()
+CHANNELS = 4
+DAYS = 7
+MESSAGES_PER_DAY = 200
+USERS = 50
+# Share of messages that start a thread, and replies per thread
+THREAD_RATIO = 0.1
+REPLIES_PER_THREAD = 5
+# Share of messages mentioning a user or channel, and share of messages with a file attached
+MENTION_DENSITY = 0.2
+ATTACHMENT_RATIO = 0.05
+# Message lengths in characters are log-normally distributed around the median, and capped at the maximum.
+#  The default tail exceeds discord's character limit, so some messages are split.
+LENGTH_MEDIAN = 80
+LENGTH_SIGMA = 1.2
+LENGTH_MAX = 8000
+
+# Timed runs of each benchmark, of which the best is compared
+REPEAT = 5
+# Slowdown of a benchmark, relative to the baseline, that is reported as a regression
+TOLERANCE = 0.2
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do", "eiusmod",
+         "tempor", "incididunt", "ut", "labore", "et", "dolore", "magna", "aliqua", "deploy", "review", "merge"]
+
+
+def random_text(rng, length, mentions, users, channels):
+    """
+    :param rng: random.Random generating the text
+    :param length: Approximate characters of the text
+    :param mentions: Whether to mention a user and a channel
+    :param users: List of user ids to mention
+    :param channels: List of channel ids to mention
+    :return: String of words, with a code block in some of the longer texts
+    """
+    words = []
+    while sum(map(len, words)) + len(words) < length:
+        words.append(rng.choice(WORDS))
+    if mentions:
+        words.insert(rng.randrange(len(words) + 1), f"<@{rng.choice(users)}>")
+        words.insert(rng.randrange(len(words) + 1), f"<#{rng.choice(channels)}>")
+    if length > 500 and rng.random() < 0.3:
+        cut = rng.randrange(len(words))
+        words[cut:cut] = ["\n```python\n"] + words[cut:cut + 20] + ["\n```\n"]
+    return " ".join(words)
+
+
+def generate_export(root, channels=CHANNELS, days=DAYS, messages_per_day=MESSAGES_PER_DAY, users=USERS,
+                    thread_ratio=THREAD_RATIO, mention_density=MENTION_DENSITY, attachment_ratio=ATTACHMENT_RATIO,
+                    length_median=LENGTH_MEDIAN, length_sigma=LENGTH_SIGMA, length_max=LENGTH_MAX, seed=0):
+    """
+    Writes a synthetic slack export: users.json, channels.json, integration_logs.json and slack2discord_users.json,
+    and a directory per channel with a .json log per day.
+    A file cache, as left by an import with --download-files, is written alongside, which must not be taken for a channel.
+    :param root: Path to the directory to write the export into
+    :param channels: Number of channels
+    :param days: Number of days of messages per channel
+    :param messages_per_day: Number of messages per channel and day, including thread replies
+    :param users: Number of users
+    :param thread_ratio: Share of messages that start a thread
+    :param mention_density: Share of messages mentioning a user and a channel
+    :param attachment_ratio: Share of messages with a file attached
+    :param length_median: Median characters of a message
+    :param length_sigma: Sigma of the log-normal distribution of message lengths
+    :param length_max: Maximum characters of a message
+    :param seed: Seed of the generator, so the same parameters always generate the same export
+    :return: Number of messages written
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    user_ids = [f"U{i:08d}" for i in range(users)]
+    names = {uid: "".join(rng.choices(string.ascii_lowercase, k=8)) for uid in user_ids}
+    channel_ids = [f"C{i:08d}" for i in range(channels)]
+    channel_names = {cid: f"channel-{i}" for i, cid in enumerate(channel_ids)}
+
+    def dump(name, data):
+        with open(os.path.join(root, name), "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+    dump("users.json", [{"id": uid, "name": name, "profile": {
+        "display_name": name if i % 3 else "", "real_name": name.title(),
+        "image_72": f"https://avatars.example.com/{uid}_72.png", "image_192": f"https://avatars.example.com/{uid}_192.png"}}
+        for i, (uid, name) in enumerate(names.items())])
+    dump("channels.json", [{"id": cid, "name": name} for cid, name in channel_names.items()])
+    dump("integration_logs.json", [])
+    # Half of the users are mapped, the rest are matched by name
+    dump("slack2discord_users.json", [{"slack": {"name": names[uid]}, "discord": {"name": names[uid], "id": ""}}
+                                      for uid in user_ids[::2]])
+    os.makedirs(os.path.join(root, slack2discord.FILE_CACHE_NAME), exist_ok=True)
+    dump(os.path.join(slack2discord.FILE_CACHE_NAME, "F00000000.json"), [])
+
+    written = 0
+    start = time.mktime((2021, 1, 1, 0, 0, 0, 0, 0, -1))
+    for cid, name in channel_names.items():
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+        open_threads = []
+        for day in range(days):
+            day_start = start + day * 86400
+            messages = []
+            for i in range(messages_per_day):
+                uid = rng.choice(user_ids)
+                ts = f"{day_start + i * 86400 / messages_per_day:.6f}"
+                length = min(length_max, max(1, int(rng.lognormvariate(0, length_sigma) * length_median)))
+                message = {"type": "message", "user": uid, "ts": ts, "client_msg_id": f"{cid}-{ts}",
+                           "text": random_text(rng, length, rng.random() < mention_density, user_ids, channel_ids),
+                           "user_profile": {"display_name": names[uid], "real_name": names[uid].title(), "name": names[uid],
+                                            "image_72": f"https://avatars.example.com/{uid}_72.png"}}
+                # Replies go to a thread started earlier, possibly on an earlier day
+                if open_threads and rng.random() < thread_ratio * REPLIES_PER_THREAD / (1 + thread_ratio * REPLIES_PER_THREAD):
+                    thread = rng.choice(open_threads)
+                    message["thread_ts"] = thread["ts"]
+                    thread["reply_count"] += 1
+                    if thread["reply_count"] >= REPLIES_PER_THREAD:
+                        open_threads.remove(thread)
+                elif rng.random() < thread_ratio:
+                    message["thread_ts"] = ts
+                    message["reply_count"] = 0
+                    open_threads.append(message)
+                if rng.random() < attachment_ratio:
+                    message["files"] = [{"id": f"F{cid}{day}{i}", "title": f"file {i}", "name": f"file_{i}.png",
+                                         "mimetype": "image/png", "timestamp": int(float(ts)),
+                                         "url_private": f"https://files.example.com/{cid}/{day}/{i}.png"}]
+                messages.append(message)
+            with open(os.path.join(root, name, time.strftime("%Y-%m-%d.json", time.localtime(day_start))), "w", encoding="utf-8") as f:
+                json.dump(messages, f)
+            written += len(messages)
+    return written
+
+
+def timed(func, repeat=REPEAT, items=None):
+    """
+    :param func: Function to time, returning the number of items it processed if items is not given
+    :param repeat: Number of timed runs
+    :param items: Number of items processed by every run
+    :return: Dict of the run's "seconds", the "best" and "median" of them, the "items" and the "items_per_second" of the best
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+        items = items if items is not None else result
+    best = min(seconds)
+    return {"seconds": seconds, "best": best, "median": statistics.median(seconds), "items": items,
+            "items_per_second": items / best if items and best else None}
+
+
+def load_messages(slack_dir):
+    return [m for fs in slack_dir["history"].values() for m in slack2discord.iter_messages(sorted(fs))]
+
+
+async def import_export(root, slack_dir, processes):
+    """
+    Imports every channel of the export with import_files, against a dry-run transport
+    :return: DryRunTransport the import was sent to
+    """
+    slack2discord.created_channels.clear()
+    transport = slack2discord.DryRunTransport()
+    ctx = slack2discord.DryRunContext(transport)
+    users, slack2discord_users, channels = slack2discord.parse_important_files(slack_dir)
+    for ch in slack_dir["history"]:
+        await slack2discord.get_or_create_channel(ctx, ch)
+    references = slack2discord.build_reference_table(ctx, users, slack2discord_users, channels)
+    pool = slack2discord.ParsePool(users, None, references, processes)
+    thread_manager = slack2discord.ThreadManager()
+    try:
+        for ch, fs in slack_dir["history"].items():
+            channel = await slack2discord.get_or_create_channel(ctx, ch)
+            await slack2discord.import_files(channel, sorted(fs), pool, slack_channel=ch, thread_manager=thread_manager)
+        await thread_manager.close()
+    finally:
+        pool.close()
+    return transport
+
+
+def run_benchmarks(root, repeat=REPEAT, processes=slack2discord.PARSE_PROCESSES):
+    """
+    :param root: Path to the slack export to benchmark against
+    :param repeat: Number of timed runs of each benchmark
+    :param processes: Parse processes of the end-to-end import
+    :return: Dict of benchmark name => timings, see timed()
+    """
+    results = {}
+
+    def locate():
+        slack2discord.ExportManifest.cache.clear()
+        return len(asyncio.run(slack2discord.parse_slack_directory(root, force_all=True))["history"])
+    results["parse_slack_directory"] = timed(locate, repeat)
+
+    slack_dir = asyncio.run(slack2discord.parse_slack_directory(root, force_all=True))
+    users, slack2discord_users, channels = slack2discord.parse_important_files(slack_dir)
+    messages = load_messages(slack_dir)
+    results["iter_messages"] = timed(lambda: len(load_messages(slack_dir)), repeat)
+    results["parse_message"] = timed(
+        lambda: sum(1 for m in messages if slack2discord.parse_message(m, users)), repeat)
+
+    ctx = slack2discord.DryRunContext(slack2discord.DryRunTransport())
+    references = slack2discord.build_reference_table(ctx, users, slack2discord_users, channels)
+    texts = [m["text"] for m in messages if m.get("text")]
+    results["fill_references"] = timed(
+        lambda: [slack2discord.fill_references(t, references) for t in texts], repeat, len(texts))
+
+    parsed = [p for p in (slack2discord.parse_message(m, users) for m in messages) if p and p["msg"]]
+    results["split_message"] = timed(
+        lambda: sum(len(slack2discord.split_message(p["msg"])) for p in parsed), repeat)
+
+    transports = []
+
+    def import_all():
+        transports.append(asyncio.run(import_export(root, slack_dir, processes)))
+        return len(parsed)
+    results["import_files"] = timed(import_all, repeat)
+    results["import_files"]["requests"] = transports[-1].counts
+    return results
+
+
+def check(results, channels):
+    """
+    :param results: Results of run_benchmarks(), against an export generated with generate_export()
+    :param channels: Number of channels generated
+    :return: List of the errors found in the results, that are no matter of timing
+    """
+    errors = []
+    created = results["import_files"]["requests"].get("channels created", 0)
+    if created != channels:
+        errors.append(f"Imported {created} channels out of {channels} generated")
+    return errors
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    :param results: Results of run_benchmarks()
+    :param baseline: Results of an earlier run, in the same format
+    :param tolerance: Slowdown of the best time, relative to the baseline, that is a regression
+    :return: Dict of benchmark name => slowdown, of the regressed benchmarks
+    """
+    regressions = {}
+    for name, result in results.items():
+        if name in baseline and baseline[name]["best"]:
+            slowdown = result["best"] / baseline[name]["best"] - 1
+            result["change"] = slowdown
+            if slowdown > tolerance:
+                regressions[name] = slowdown
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the slack2discord import pipeline on a generated Slack export",
+                                     allow_abbrev=False)
+    parser.add_argument("--export", help="benchmark an existing export instead of generating one")
+    parser.add_argument("--keep", help="generate the export into this directory and keep it, rather than a temporary one")
+    parser.add_argument("--channels", type=int, default=CHANNELS)
+    parser.add_argument("--days", type=int, default=DAYS)
+    parser.add_argument("--messages-per-day", type=int, default=MESSAGES_PER_DAY)
+    parser.add_argument("--users", type=int, default=USERS)
+    parser.add_argument("--thread-ratio", type=float, default=THREAD_RATIO)
+    parser.add_argument("--mention-density", type=float, default=MENTION_DENSITY)
+    parser.add_argument("--attachment-ratio", type=float, default=ATTACHMENT_RATIO)
+    parser.add_argument("--length-median", type=int, default=LENGTH_MEDIAN)
+    parser.add_argument("--length-sigma", type=float, default=LENGTH_SIGMA)
+    parser.add_argument("--length-max", type=int, default=LENGTH_MAX)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="timed runs of each benchmark")
+    parser.add_argument("--processes", type=int, default=slack2discord.PARSE_PROCESSES,
+                        help="parse processes of the import (0 parses in a thread)")
+    parser.add_argument("--output", help="write the results to this file, rather than stdout")
+    parser.add_argument("--baseline", help="results of an earlier run, exiting with 1 if any benchmark regressed")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="slowdown relative to the baseline that is a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    # Only the results are written to stdout
+    slack2discord.log.addHandler(logging.NullHandler())
+    slack2discord.log.setLevel(logging.CRITICAL)
+    slack2discord.log.propagate = False
+    slack2discord.THROTTLE = False
+    slack2discord.ASSUME_YES = True
+
+    params = {k: v for k, v in vars(args).items() if k not in ("export", "keep", "output", "baseline", "tolerance")}
+    root = args.export or args.keep or tempfile.mkdtemp(prefix="slack2discord_bench_")
+    try:
+        if not args.export:
+            params["messages"] = generate_export(
+                root, args.channels, args.days, args.messages_per_day, args.users, args.thread_ratio, args.mention_density,
+                args.attachment_ratio, args.length_median, args.length_sigma, args.length_max, args.seed)
+        results = run_benchmarks(root, args.repeat, args.processes)
+        errors = [] if args.export else check(results, args.channels)
+    finally:
+        if not (args.export or args.keep):
+            shutil.rmtree(root, ignore_errors=True)
+
+    regressions = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+    report = {"python": platform.python_version(), "discord.py": discord.__version__, "platform": platform.platform(),
+              "params": params, "results": results, "regressions": regressions, "errors": errors}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if regressions or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())